@@ -21,6 +21,8 @@ class ktamv:
         self.calib_value = config.getfloat("calib_value", 1.0, above=0.25)
         self.send_frame_to_cloud = config.getboolean("send_frame_to_cloud", False)
         self.detection_tolerance = config.getint("detection_tolerance", 0, minval=0, maxval=5)
+        self.parallel_detection = config.getboolean("parallel_detection", False)
+        self.grayscale_detection = config.getboolean("grayscale_detection", False)
 
         # Initialize variables
         self.mpp = None  # Average mm per pixel
@@ -124,6 +126,8 @@ class ktamv:
                 camera_url=_camera_url,
                 send_frame_to_cloud=self.send_frame_to_cloud,
                 detection_tolerance=self.detection_tolerance,
+                parallel_detection=self.parallel_detection,
+                grayscale_detection=self.grayscale_detection,
             )
             # gcmd.respond_info("Sent server configuration to server")
             gcmd.respond_info("kTAMV Server response: %s" % str(rr))
@@ -184,7 +188,7 @@ class ktamv:
         ##############################
         logging.debug("*** calling KTAMV_SIMPLE_NOZZLE_POSITION")
         try:
-            _response = utl.get_nozzle_position(self.server_url, self.reactor)
+            _response = utl.get_nozzle_position(self.server_url, self.reactor, self._get_active_tool())
             if _response is None:
                 raise self.gcode.error("Did not find nozzle, aborting")
             else:
@@ -192,6 +196,9 @@ class ktamv:
                     "Found nozzle at position: %s after %.2f seconds"
                     % (str(_response["data"]), float(_response["runtime"]))
                 )
+                _timings = utl.format_timings(_response.get("timings"))
+                if _timings:
+                    self.gcode.respond_info("Timings: " + _timings)
         except Exception as e:
             raise self.gcode.error(
                 "Failed to run burstNozzleDetection, got error: %s" % str(e)
@@ -234,7 +241,7 @@ class ktamv:
         try:
             self.pm.ensureHomed()
             # _Request_Result
-            _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+            _rr = utl.get_nozzle_position(self.server_url, self.reactor, self._get_active_tool())
 
             # If we did not get a response at first querry, abort
             if _rr is None:
@@ -377,7 +384,7 @@ class ktamv:
             # Move to the new center and get the nozzle position to update the camera
             self.pm.moveAbsolute(X=guessPosition[0], Y=guessPosition[1])
             try:
-                _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+                _rr = utl.get_nozzle_position(self.server_url, self.reactor, self._get_active_tool())
             except NozzleNotFoundException as e:
                 pass
 
@@ -423,7 +430,7 @@ class ktamv:
             # It ends when the nozzle position is the same 3 times in a row
             for _retries in range(retries):
                 # _Request_Result
-                _rr = utl.get_nozzle_position(self.server_url, self.reactor)
+                _rr = utl.get_nozzle_position(self.server_url, self.reactor, self._get_active_tool())
 
                 # If we did not get a response, try to wiggle the toolhead
                 if _rr is None:
@@ -575,7 +582,7 @@ class ktamv:
         self.pm.moveRelative(X=X, Y=Y)
 
         # Get the nozzle position
-        _request_result = utl.get_nozzle_position(self.server_url, self.reactor)
+        _request_result = utl.get_nozzle_position(self.server_url, self.reactor, self._get_active_tool())
 
         # If we did not get a response, return None
         if _request_result is None:
@@ -586,6 +593,13 @@ class ktamv:
 
         return _request_result, [_current_position[0], _current_position[1]]
 
+    # Returns the name of the active extruder. The server learns which detector works best for each tool.
+    def _get_active_tool(self):
+        try:
+            return self.printer.lookup_object("toolhead").get_extruder().get_name()
+        except Exception:
+            return None
+
     def _save_coordinates_for_matrix(self, space_coordinates, camera_coordinates, mpp):
         # Save the 3D space coordinates and 2D camera coordinates to lists for later use
         self.space_coordinates.append(space_coordinates)  # (_xy[0], _xy[1]))
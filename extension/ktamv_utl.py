@@ -1,5 +1,5 @@
 # kTAMV Utility Functions
-import json, time
+import json, time, threading
 from statistics import mean, stdev
 import logging
 
@@ -11,6 +11,10 @@ import urllib.request
 from email.message import Message  # For headers in server_request
 
 __SERVER_REQUEST_TIMEOUT = 2
+# Seconds the server waits for a detection to finish before answering that it is still running
+__RESULT_WAIT = 10
+# Seconds to wait for a nozzle to be detected, the server stops looking after this
+__DETECTION_TIMEOUT = 60
 __FRAME_WIDTH = 640
 __FRAME_HEIGHT = 480
 
@@ -54,15 +58,20 @@ def calculate_offset_from_matrix(server_url, _v):
     return rr.body
 
 
-def get_nozzle_position(server_url, reactor):
+def get_nozzle_position(server_url, reactor, tool=None):
     ##############################
     # Get nozzle position
     ##############################
     logging.debug("*** calling ktamv_utl.get_nozzle_position")
     _request_id = None
 
+    # The server orders its detectors by what worked before for this tool
+    _params = {"timeout": __DETECTION_TIMEOUT}
+    if tool is not None:
+        _params["tool"] = tool
+
     # First load the server response and check that it is working
-    _response = server_request(server_url + "/getNozzlePosition", timeout=__SERVER_REQUEST_TIMEOUT)
+    _response = server_request(server_url + "/getNozzlePosition", params=_params, timeout=__SERVER_REQUEST_TIMEOUT)
     if _response.status != 200:
         raise Exception(
             "When getting nozzle position, server sent statuscode %s: %s"
@@ -88,9 +97,12 @@ def get_nozzle_position(server_url, reactor):
         # Check if the request is done
         #
 
-        # First load the server response and check that it is working
-        _response = server_request(
-            f"{server_url}/getReqest?request_id={_request_id}", timeout=2
+        # Wait for the server to answer as soon as the request is done
+        _poll_start = time.time()
+        _response = server_request_in_thread(
+            reactor,
+            f"{server_url}/getReqest?request_id={_request_id}&wait={__RESULT_WAIT}",
+            timeout=__RESULT_WAIT + __SERVER_REQUEST_TIMEOUT,
         )
         if _response.status != 200:
             raise Exception(
@@ -100,15 +112,25 @@ def get_nozzle_position(server_url, reactor):
         # Then load the response content as JSON and check that the statuscode is Accepted (202) or OK (200)
         _response = json.loads(_response.body)
         if _response["statuscode"] == 202:
-            # Check if one minute has elapsed
+            # Check if the detection timeout has elapsed
             elapsed_time = time.time() - start_time
-            if elapsed_time >= 60:
+            if elapsed_time >= __DETECTION_TIMEOUT:
+                # Let the server stop looking, it is not needed anymore
+                try:
+                    server_request(
+                        f"{server_url}/cancelRequest?request_id={_request_id}",
+                        timeout=__SERVER_REQUEST_TIMEOUT,
+                    )
+                except Exception:
+                    pass
                 raise NozzleNotFoundException(
-                    "Nozzle detection timed out after 60 seconds, Server still looking for nozzle."
+                    "Nozzle detection timed out after %d seconds, Server still looking for nozzle."
+                    % __DETECTION_TIMEOUT
                 )
 
-            # Pause for 200ms to avoid busy loop, this equals checking 5 times per second
-            _ = reactor.pause(reactor.monotonic() + 0.200)
+            # A server not supporting wait answers at once, pause for 200ms to avoid a busy loop
+            if time.time() - _poll_start < __RESULT_WAIT / 2:
+                _ = reactor.pause(reactor.monotonic() + 0.200)
             continue
         # If nozzles were found, return the position
         elif _response["statuscode"] == 200:
@@ -127,6 +149,28 @@ def get_nozzle_position(server_url, reactor):
             )
 
 
+# Returns a one line summary of where the time of a nozzle detection went,
+# from the timings in the server response. Empty if the server did not send timings.
+def format_timings(timings, max_spans=5):
+    if not timings:
+        return ""
+    summary = "queued %.2fs, ran %.2fs, %d frames (%d skipped, %d without nozzle), %d consensus rounds" % (
+        timings.get("queued", 0),
+        timings.get("run", 0),
+        timings.get("frames", 0),
+        timings.get("frames_skipped", 0),
+        timings.get("frames_without_nozzle", 0),
+        timings.get("consensus_rounds", 0),
+    )
+    # The stages taking the most time
+    spans = sorted(timings.get("spans", {}).items(), key=lambda item: item[1]["total"], reverse=True)
+    if spans:
+        summary += "; " + ", ".join(
+            "%s %.2fs/%d" % (name, span["total"], span["count"]) for name, span in spans[:max_spans]
+        )
+    return summary
+
+
 def get_average_mpp(
     mpps: list, space_coordinates: list, camera_coordinates: list, gcmd
 ):
@@ -338,6 +382,29 @@ class Server_Response(typing.NamedTuple):
         return output
 
 
+####################################################################################################
+# Make a server request in a separate thread, letting the Klipper reactor run while waiting
+####################################################################################################
+def server_request_in_thread(reactor, url: str, timeout: int = __SERVER_REQUEST_TIMEOUT, **kwargs) -> Server_Response:
+    completion = reactor.completion()
+
+    def _request():
+        try:
+            _result = (server_request(url, timeout=timeout, **kwargs), None)
+        except Exception as e:
+            _result = (None, e)
+        reactor.register_async_callback(lambda eventtime: completion.complete(_result))
+
+    threading.Thread(target=_request, daemon=True).start()
+    _result = completion.wait(reactor.monotonic() + timeout + 1.0)
+    if _result is None:
+        raise TimeoutError("Server did not answer %s within %s seconds" % (url, str(timeout)))
+    _response, _error = _result
+    if _error is not None:
+        raise _error
+    return _response
+
+
 def server_request(
     url: str,
     data: dict = None,
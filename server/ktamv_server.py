@@ -1,38 +1,77 @@
 # import the Flask module, the MJPEGResponse class, and the os module
-import datetime, io, time, random, os, numpy as np, threading
-from flask import Flask, jsonify, request, send_file #, send_from_directory
-from PIL import Image, ImageDraw, ImageFont  #, ImageFile
+import datetime, html, time, os, numpy as np
+from flask import Flask, Response, jsonify, request #, send_from_directory
+from PIL import Image  #, ImageFile
 from argparse import ArgumentParser
-import matplotlib.font_manager as fm
 from waitress import serve
 import logging, json, traceback
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
 from ktamv_server_dm import Ktamv_Server_Detection_Manager as dm
+from ktamv_server_results import Ktamv_Server_Result_Store
+from ktamv_server_events import Ktamv_Server_Event_Bus
+from ktamv_server_preview import Ktamv_Server_Frame_Broadcaster, Ktamv_Server_Preview_Format
+from ktamv_server_overlay import Ktamv_Server_Overlay
+from ktamv_server_scheduler import Ktamv_Server_Preview_Scheduler
+from ktamv_server_jobs import Ktamv_Server_Job_Queue
+from ktamv_server_log import Ktamv_Server_Log
+from ktamv_server_metrics import metrics
+from ktamv_server_sources import parse_frame_source_url
 
-__logdebug = ""
 # URL to the cloud server
 __CLOUD_URL = "http://ktamv.ignat.se/index.php"
 # If no nozzle found in this time, timeout the function
 __CV_TIMEOUT = 20  
 # Minimum amount of matches to confirm toolhead position after a move
 __CV_MIN_MATCHES = 3 
+# Seconds a client waits for a detection when it does not say, and the most it can ask for.
+# Jobs are dropped or stopped when no client waits for them anymore.
+__JOB_DEADLINE_DEFAULT = 60
+__JOB_DEADLINE_MAX = 600
+# Maximum amount of detection jobs waiting to run
+__JOB_QUEUE_MAX = 16
+
+# Amount of log messages kept in memory, the lowest level logged and the most returned by one call to getLog
+__LOG_MAX_RECORDS = 2000
+__LOG_LEVEL = "INFO"
+__LOG_PAGE_MAX = 1000
+# Amount of log messages and bytes of the log file shown on the status page
+__LOG_INDEX_RECORDS = 200
+__LOG_INDEX_FILE_BYTES = 64 * 1024
 # Size of frame to use
 _FRAME_WIDTH = 640
 _FRAME_HEIGHT = 480
 
-# FPS to use when running the preview
+# Seconds to keep a request result and the maximum amount of results kept
+__RESULT_TTL = 3600
+__RESULT_MAX = 500
+# Maximum amount of results returned by one call to getAllReqests
+__RESULT_PAGE_MAX = 500
+# Maximum seconds getReqest waits for a pending request to finish
+__RESULT_WAIT_MAX = 30
+
+# Maximum seconds /image?since= waits for a newer frame
+__IMAGE_WAIT_MAX = 5
+# Time the server started, part of the image ETag
+__SERVER_STARTED = int(time.time() * 1000)
+
+# Boundary between the frames of the MJPEG stream
+__STREAM_BOUNDARY = "ktamvframe"
+# Smallest width the preview can be scaled down to
+__PREVIEW_MIN_WIDTH = 32
+
+# Highest FPS to use when running the preview, and the FPS when nobody is watching it
 __PREVIEW_FPS = 2
+__PREVIEW_IDLE_FPS = 0.2
+# Largest part of a CPU core the preview may use, it runs at a lower FPS if frames take longer
+__PREVIEW_MAX_CPU_SHARE = 0.5
+# Seconds since /image was last asked for that someone is still considered watching
+__VIEWER_TIMEOUT = 10
 
 # If the nozzle position is within this many pixels when comparing frames, it's considered a match. Only whole numbers are supported.
 __detection_tolerance = 0
-# Wheather to update the image at next request
-__update_static_image = True
 # Error message to show on the image
 __error_message_to_image = ""
 
-# Indicates if preview is running
-__preview_running = False
-
 # Create logs folder if it doesn't exist and configure logging
 if not os.path.exists("./logs"):
     os.makedirs("logs")
@@ -44,23 +83,53 @@ logging.basicConfig(
     filemode="w",
     encoding="utf-8",
 )
+# The last log messages, with their level, time and the job that logged them
+server_log = Ktamv_Server_Log(__LOG_MAX_RECORDS, __LOG_LEVEL, logging.getLogger("ktamv"))
 
 # create a Flask app
 app = Flask(__name__)
 
 
-# Define a global variable to store the processed frame in form of an image
-__processed_frame_as_image = None
-# Define a global variable to store the processed frame in form of bytes
-__processed_frame_as_bytes = None
+# The last frame from the camera as it is and the detection in it, drawn only when someone wants to see it
+__last_frame = (None, None)
 # The loaded standby image
 __standby_image = None
 # Define a global variable to store the camera path.
 _camera_url = None
+# The detection engine for the configured camera, created by set_server_cfg and reused by every request
+_detection_manager = None
 # Whether to send the frame to the cloud
 __send_frame_to_cloud = False
-# Define a global variable to store a key-value pair of the request id and the result
-request_results = dict()
+# Whether to run the detector combos in parallel on a thread pool
+__parallel_detection = False
+# Whether to decode frames without color for detection, faster but it can change which nozzle is found
+__grayscale_detection = False
+# Sends job, position and frame events to the clients of /events
+event_bus = Ktamv_Server_Event_Bus()
+# Stores the request results by request id, bounded in age and size. Every change is sent as a job event.
+request_results = Ktamv_Server_Result_Store(
+    __RESULT_TTL, __RESULT_MAX, on_put=lambda result: event_bus.publish("job", asdict(result))
+)
+# Draws the text on the preview frame with the font loaded once
+overlay = Ktamv_Server_Overlay()
+# Renders and shares the preview frame with all viewers of /image and /stream
+frame_broadcaster = Ktamv_Server_Frame_Broadcaster(lambda: render_frame())
+# Runs the preview at a limited FPS on one thread, paused while detection requests use the camera
+preview_scheduler = Ktamv_Server_Preview_Scheduler(
+    log = lambda message, *args, **kwargs: log(message, *args, **kwargs),
+    run_frame = lambda: preview_frame(),
+    has_viewers = lambda: frame_broadcaster.has_viewers(__VIEWER_TIMEOUT) or event_bus.subscriber_count() > 0,
+    max_fps = __PREVIEW_FPS,
+    idle_fps = __PREVIEW_IDLE_FPS,
+    max_cpu_share = __PREVIEW_MAX_CPU_SHARE,
+)
+# Runs the detection jobs one at a time, requests for the same tool share a job
+job_queue = Ktamv_Server_Job_Queue(
+    log = lambda message, *args, **kwargs: log(message, *args, **kwargs),
+    run_job = lambda job: run_detection_job(job),
+    finish_job = lambda job, requests, result: finish_detection_job(job, requests, result),
+    max_queued = __JOB_QUEUE_MAX,
+)
 # The transform matrix calculated from the calibration points
 _transformMatrix = None
 
@@ -72,6 +141,9 @@ class Ktamv_Request_Result:
     runtime: float = None
     statuscode: int = None
     statusmessage: str = None
+    # Where the time of a detection went: seconds queued and running, frames and consensus rounds,
+    # and the count, total and longest seconds of every stage as spans
+    timings: dict = None
     
 
 # Returns the transposed matrix calculated from the calibration points
@@ -105,7 +177,7 @@ def calculate_camera_to_space_matrix():
                 return "OK", 200
     except Exception as e:
         show_error_message_to_image("Error: Could not calculate image to space matrix.")
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
         return ""
 
 @app.route("/calculate_offset_from_matrix", methods=["POST"])
@@ -120,14 +192,14 @@ def calculate_offset_from_matrix():
             log("_transformMatrix: " + str(_transformMatrix))
             # _transformMatrix = data.get("transformMatrix")
         except json.JSONDecodeError:
-            log("JSON Decode Error")
+            log("JSON Decode Error", level=logging.WARNING)
             return "JSON Decode Error", 400
         
         offsets = -1 * (0.55 * _transformMatrix @ _v)
         return jsonify(offsets.tolist())
     except Exception as e:
         show_error_message_to_image("Error: Could not calculate offset from matrix.")
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
 
 @app.route("/set_server_cfg", methods=["POST"])
 def set_server_cfg():
@@ -138,8 +210,8 @@ def set_server_cfg():
         response = ""
 
         # Stoping preview if running
-        global __preview_running, __detection_tolerance, __send_frame_to_cloud
-        __preview_running = False
+        global __detection_tolerance, __send_frame_to_cloud, __parallel_detection, __grayscale_detection
+        preview_scheduler.stop()
         
         # Get the camera path from the JSON object
         try:
@@ -169,46 +241,147 @@ def set_server_cfg():
         except:
             pass
 
+        try:
+            data = json.loads(request.data)
+            parallel_detection = data.get("parallel_detection")
+        except:
+            parallel_detection = None
+
+        if parallel_detection is not None:
+            __parallel_detection = parallel_detection == True
+            response += "parallel_detection set to %s\n" % str(__parallel_detection)
+
+        try:
+            data = json.loads(request.data)
+            grayscale_detection = data.get("grayscale_detection")
+        except:
+            grayscale_detection = None
+
+        if grayscale_detection is not None:
+            __grayscale_detection = grayscale_detection == True
+            response += "grayscale_detection set to %s\n" % str(__grayscale_detection)
+
+        try:
+            data = json.loads(request.data)
+            log_level = data.get("log_level")
+        except:
+            log_level = None
+
+        if log_level is not None:
+            try:
+                server_log.set_level(log_level)
+                response += "log_level set to %s\n" % logging.getLevelName(server_log.level)
+            except ValueError as e:
+                response += str(e) + "\n"
+
         if camera_url is None:
             show_error_message_to_image("Error: Could not set camera URL.")
             return "Camera path not found in JSON", 400
         else:
-            if camera_url.casefold().startswith(
-                "http://"
-            ) or camera_url.casefold().startswith("https://"):
+            try:
+                parse_frame_source_url(camera_url)
+                camera_url_error = None
+            except ValueError as e:
+                camera_url_error = str(e)
+            if camera_url_error is None:
                 global _camera_url
                 _camera_url = camera_url
+                configure_detection_manager()
                 # Return code 200 to web browser
-                log(f"*** end of set_server_cfg (set to {_camera_url}) ***<br>")
+                log(f"*** end of set_server_cfg (set to {_camera_url}) ***", level=logging.INFO)
                 show_error_message_to_image("Camera url set.")
                 return response + "Camera path set to " + _camera_url, 200
             else:
                 show_error_message_to_image("Error: Invalid nozzle_cam_url.")
-                log("*** end of set_server_cfg (not set) ***<br>")
-                return "Camera path must start with http:// or https://", 400
+                log("*** end of set_server_cfg (not set) ***")
+                return camera_url_error, 400
     except Exception as e:
         show_error_message_to_image("Error: Could not set camera URL.")
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
+
+# Creates the detection engine for the configured camera, or keeps the current one and what it has
+# learned if the camera and detection mode did not change. The camera stream is opened right away.
+def configure_detection_manager():
+    global _detection_manager
+    if (
+        _detection_manager is not None
+        and _detection_manager.camera_url == _camera_url
+        and _detection_manager.parallel == __parallel_detection
+    ):
+        _detection_manager.send_to_cloud = __send_frame_to_cloud
+        _detection_manager.grayscale = __grayscale_detection
+        return
+    if _detection_manager is not None:
+        # A running job stops at its next frame, the request does not wait for it
+        _detection_manager.close(wait=False)
+    _detection_manager = dm(
+        log, _camera_url, __CLOUD_URL, __send_frame_to_cloud, parallel = __parallel_detection,
+        grayscale = __grayscale_detection, log_enabled = server_log.enabled
+    )
+    _detection_manager.open_stream()
 
 
-# Called from DetectionManager to put the frame in the global variable so it can be sent to the web browser
-def put_frame(frame):
+# Called from DetectionManager to put the frame in the global variable so it can be sent to the web browser.
+# Only keeps the frame, it is drawn on and encoded when a viewer asks for it, not at all if nobody is watching.
+# frame: The color frame, or a function returning it to only decode it when a viewer asks for it
+# detection: The detection in the frame, drawn on it for viewers
+# timestamp: The time.time() the frame arrived from the camera
+def put_frame(frame, detection=None, timestamp=None):
     try:
-        global __processed_frame_as_image, __update_static_image
-        # Convert the frame to a PIL Image
-        __processed_frame_as_image = Image.fromarray(frame)
-        __update_static_image = True
+        global __last_frame
+        __last_frame = (frame, detection)
+        # The same version as X-Frame-Version and the ETag of /image, so it can be used with ?since=
+        version = frame_broadcaster.invalidate()
+
+        position = None if detection is None else detection.center
+        event_bus.publish("frame", {"version": version, "time": timestamp})
+        event_bus.publish("position", {"position": position, "time": timestamp, "version": version})
         
     except Exception as e:
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
+
+# Streams job state changes, detected positions and new frame versions as Server-Sent Events.
+# types: Comma separated event types to receive, any of job, position and frame. All if not given.
+@app.route("/events")
+def events():
+    try:
+        types = request.args.get("types", default=None)
+        event_types = None if types is None else [t.strip() for t in types.split(",") if t.strip()]
+        return Response(
+            event_bus.stream(event_types),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    except Exception as e:
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
+
+@app.route("/getCascadeStats")
+def getCascadeStats():
+    try:
+        if _detection_manager is None:
+            return "Camera URL not set", 502
+        return jsonify(_detection_manager.get_cascade_stats())
+    except Exception as e:
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
 
 
 @app.route("/getAllReqests")
 def getAllReqests():
     try:
-        return jsonify(request_results)
+        # Optional filters and paging
+        status = request.args.get("status", type=int, default=None)
+        since = request.args.get("since", type=float, default=None)
+        until = request.args.get("until", type=float, default=None)
+        offset = max(request.args.get("offset", type=int, default=0), 0)
+        limit = min(max(request.args.get("limit", type=int, default=100), 0), __RESULT_PAGE_MAX)
+
+        total, results = request_results.query(status, since, until, offset, limit)
+        return jsonify({"total": total, "offset": offset, "limit": limit, "results": results})
     except Exception as e:
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
 
 
 @app.route("/")
@@ -222,10 +395,25 @@ def index():
         + str(_FRAME_HEIGHT)
         + "<br>"
     )
-    content += "Debuging log:<br>" + __logdebug + "<br>"
+    # Only the last messages, all of them can be read page by page from /getLog
+    _, records = server_log.query(offset=max(len(server_log) - __LOG_INDEX_RECORDS, 0), limit=__LOG_INDEX_RECORDS)
+    content += "Debuging log (last %d messages, all on /getLog):<br>" % __LOG_INDEX_RECORDS
+    for record in records:
+        content += html.escape(
+            "%s %-8s %s%s" % (
+                datetime.datetime.fromtimestamp(record.time).strftime("%H:%M:%S.%f")[:-3],
+                record.level,
+                "" if record.job_id is None else "[job %d] " % record.job_id,
+                record.message,
+            )
+        ).replace("\n", "<br>") + "<br>"
+    content += "<br>"
     try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            content += file.read()
+        with open(file_path, "r", encoding="utf-8", errors="replace") as file:
+            # Only the end of the log file
+            file.seek(0, os.SEEK_END)
+            file.seek(max(file.tell() - __LOG_INDEX_FILE_BYTES, 0))
+            content += html.escape(file.read())
 
             # Replace line breaks with HTML line breaks
             content = content.replace("\n", "<br>")
@@ -237,100 +425,182 @@ def index():
         return content + "Log file not found"
 
 
+# Returns the kept log messages, oldest first.
+# level: Only messages of this level or above, e.g. INFO
+# job_id: Only messages logged by this detection job
+# after: Only messages with a seq above this, pass the last seq received to only get new messages
+# offset, limit: The page of messages to return
+@app.route("/getLog")
+def getLog():
+    try:
+        level = request.args.get("level", default=None)
+        job_id = request.args.get("job_id", type=int, default=None)
+        after = request.args.get("after", type=int, default=None)
+        offset = max(request.args.get("offset", type=int, default=0), 0)
+        limit = min(max(request.args.get("limit", type=int, default=100), 0), __LOG_PAGE_MAX)
+        try:
+            total, records = server_log.query(level, job_id, after, offset, limit)
+        except ValueError as e:
+            return str(e), 400
+        return jsonify({"total": total, "offset": offset, "limit": limit, "level": logging.getLevelName(server_log.level), "records": records})
+    except Exception as e:
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
+
 @app.route("/getReqest", methods=["GET", "POST"])
 def getReqest():
     try:
         # Get the request id from the URL
         request_id = request.args.get("request_id", type=int, default=None)
+        # Seconds to wait for the request to finish before returning it as pending
+        wait = min(max(request.args.get("wait", type=float, default=0), 0), __RESULT_WAIT_MAX)
 
         # Return the request result if it exists, otherwise return a 404
-        try:
-            return jsonify(request_results[request_id])
-        except KeyError:
+        result = request_results.wait(request_id, wait)
+        if result is not None:
+            return jsonify(result)
+        else:
             return jsonify(
                 Ktamv_Request_Result(
                     request_id, None, None, 404, "Request not found"
                 )
             )
     except Exception as e:
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
 
 
 @app.route("/getNozzlePosition")
 def getNozzlePosition():
     show_error_message_to_image("")
-    # Stoping preview if running
-    global __preview_running
-    __preview_running = False
 
     try:
         log("*** calling getNozzlePosition ***")
         start_time = time.time()  # Get the current time
 
-        # Get a random request id
-        request_id = random.randint(0, 1000000)
+        # Only use frames captured after this time. Defaults to when the request arrived,
+        # the extension calls this after waiting for the moves to finish.
+        captured_after = request.args.get("captured_after", type=float, default=start_time)
+        # The tool over the camera, the detector cascade is ordered by what worked for it before
+        tool = request.args.get("tool", default=None)
+        # Seconds the client waits for the result, the job is stopped after that if nobody else waits for it
+        timeout = min(max(request.args.get("timeout", type=float, default=__JOB_DEADLINE_DEFAULT), 0), __JOB_DEADLINE_MAX)
 
-        if _camera_url is None:
-            request_results[request_id] = Ktamv_Request_Result(
+        # Get a new request id
+        request_id = request_results.new_id()
+
+        if _detection_manager is None:
+            request_result_object = Ktamv_Request_Result(
                 request_id, None, time.time() - start_time, 502, "Camera URL not set"
             )
-            log("*** end of getNozzlePosition - Camera URL not set ***<br>")
-            return jsonify(request_results[request_id])
+            request_results.put(request_id, request_result_object)
+            log("*** end of getNozzlePosition - Camera URL not set ***", level=logging.WARNING)
+            return jsonify(request_result_object)
 
 
-        request_results[request_id] = Ktamv_Request_Result(
+        accepted_result = Ktamv_Request_Result(
             request_id, None, None, 202, "Accepted"
         )
-        log("request_results: " + str(request_results))
+        request_results.put(request_id, accepted_result)
+        log("request_results size: " + str(len(request_results)))
 
-        def do_work():
-            log("*** calling do_work ***")
-            detection_manager = dm(
-                log, _camera_url, __CLOUD_URL, __send_frame_to_cloud
+        job = job_queue.submit(request_id, tool, captured_after, start_time + timeout)
+        if job is None:
+            request_result_object = Ktamv_Request_Result(
+                request_id, None, time.time() - start_time, 503, "Too many detection requests waiting"
             )
+            request_results.put(request_id, request_result_object)
+            log("*** end of getNozzlePosition - Job queue full ***", level=logging.WARNING)
+            return jsonify(request_result_object)
+        log("request %d added to job %d", request_id, job.job_id, level=logging.INFO)
 
+        log("*** end of getNozzlePosition ***")
+        return jsonify(accepted_result)
+    except Exception as e:
+        show_error_message_to_image("Error: Could not get nozzle position.")
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
+# Runs a detection job from the job queue and returns a tuple of the position found, or None,
+# and the Ktamv_Server_Timeline of the job
+def run_detection_job(job):
+    # Everything logged while running the job is marked with its id, and every stage timed is added to its timeline
+    with server_log.job(job.job_id), metrics.timeline() as timeline:
+        log("*** calling do_work ***")
+        detection_manager = _detection_manager
+        if detection_manager is None:
+            return None, timeline
+        detection_manager.set_tool(job.tool)
+
+        # A running preview waits until the camera is free again
+        with preview_scheduler.paused():
             position = detection_manager.recursively_find_nozzle_position(
-                put_frame, __CV_MIN_MATCHES, __CV_TIMEOUT, __detection_tolerance
+                put_frame, __CV_MIN_MATCHES, __CV_TIMEOUT, __detection_tolerance, job.captured_after, job.should_stop
             )
 
-            log("position: " + str(position))
-
-            if position is None:
-                request_result_object = Ktamv_Request_Result(
-                    request_id, None, time.time() - start_time, 404, "No nozzle found"
-                )
-                show_error_message_to_image("Error: No nozzle found.")
-            else:
-                request_result_object = Ktamv_Request_Result(
-                    request_id,
-                    json.dumps(position),
-                    time.time() - start_time,
-                    200,
-                    "OK"
-                )
+        log("position: %s", position, level=logging.INFO)
+        log("*** end of do_work ***")
+        return position, timeline
+
+
+# Stores the result of a detection job for every request that waited for it.
+# result: The tuple returned by run_detection_job, None if the job did not run
+def finish_detection_job(job, requests, result):
+    now = time.time()
+    position, timeline = (None, None) if result is None else result
+    summary = {} if timeline is None else timeline.summary()
+    if position is not None:
+        data, statuscode, statusmessage = json.dumps(position), 200, "OK"
+    elif job.started is None or now > job.deadline:
+        data, statuscode, statusmessage = None, 408, "Deadline passed"
+    else:
+        data, statuscode, statusmessage = None, 404, "No nozzle found"
+        show_error_message_to_image("Error: No nozzle found.")
+
+    for request_id, submitted in requests.items():
+        timings = {
+            "queued": round((now if job.started is None else job.started) - submitted, 4),
+            "run": 0 if job.started is None else round(now - job.started, 4),
+            **summary,
+        }
+        request_results.put(
+            request_id,
+            Ktamv_Request_Result(request_id, data, now - submitted, statuscode, statusmessage, timings)
+        )
 
-            global request_results
-            request_results[request_id] = request_result_object
 
-            log("*** end of do_work ***")
+# Cancels a detection request. The job stops when no other request waits for it.
+@app.route("/cancelRequest", methods=["GET", "POST"])
+def cancelRequest():
+    try:
+        request_id = request.args.get("request_id", type=int, default=None)
+        if job_queue.cancel(request_id):
+            result = Ktamv_Request_Result(request_id, None, None, 410, "Cancelled")
+            request_results.put(request_id, result)
+            log("request %d cancelled", request_id, level=logging.INFO)
+            return jsonify(result)
+
+        # Already finished or never existed
+        result = request_results.get(request_id)
+        if result is None:
+            result = Ktamv_Request_Result(request_id, None, None, 404, "Request not found")
+        return jsonify(result)
+    except Exception as e:
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
 
-        thread = threading.Thread(target=do_work)
-        thread.start()
 
-        log("*** end of getNozzlePosition ***<br>")
-        return jsonify(request_results[request_id])
+# Returns the amount of detection jobs waiting, the running job and how long jobs waited
+@app.route("/getJobQueue")
+def getJobQueue():
+    try:
+        return jsonify(job_queue.stats())
     except Exception as e:
-        show_error_message_to_image("Error: Could not get nozzle position.")
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
 
 @app.route("/preview", methods=["POST"])
 def preview():
     show_error_message_to_image("")
     try:
         log("*** calling preview ***")
-        start_time = time.time()  # Get the current time
-        global __preview_running
-
         try:
             data = json.loads(request.data)
             action = data.get("action")
@@ -338,41 +608,61 @@ def preview():
             show_error_message_to_image("Error: Could not get action.")
             return "JSON Decode Error", 400
 
-        def do_preview():
-            log("*** calling do_preview ***")
-            # Do not send images from preview to the cloud
-            detection_manager = dm(
-                log, _camera_url, cloud_url = "", send_to_cloud = False
-            )
-            
-            while __preview_running:
-                dm.get_preview_frame(detection_manager, put_frame)
-                
-
-            log("*** end of do_preview ***")
-
-            # Wait for 1s/FPS for a maximum FPS.
-            # This is to avoid overloading the server
-            time.sleep(1 / __PREVIEW_FPS)
-
         # Handle the action
         if action == "stop":
-            __preview_running = False
+            preview_scheduler.stop()
             return "Stopped preview.", 200
         elif action == "start":
-            if _camera_url is None:
-                log("*** end of preview - Camera URL not set ***<br>")
+            if _detection_manager is None:
+                log("*** end of preview - Camera URL not set ***", level=logging.WARNING)
                 return "Camera URL not set", 502
             else:
-                __preview_running = True
-                thread = threading.Thread(target=do_preview)
-                thread.start()
+                if not preview_scheduler.start():
+                    return "Preview already running.", 200
                 return "Started preview.", 200
         else:
             return "Invalid action.", 400
     except Exception as e:
         show_error_message_to_image("Error: Could not do preview.")
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
+# Returns the metrics in the Prometheus text exposition format, to be scraped by Prometheus or read as text.
+# Stage latencies are in ktamv_stage_seconds: fetch, decode, resize, gamma, preprocess, detect,
+# render, overlay, encode and cloud_upload. ktamv_combo_seconds has the blob detection of every combo.
+@app.route("/metrics")
+def getMetrics():
+    try:
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+    except Exception as e:
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
+
+# Returns the current values of the server state for /metrics
+def collect_metrics():
+    queue_stats = job_queue.stats()
+    preview_stats = preview_scheduler.stats()
+    return [
+        ("ktamv_job_queue_depth", "gauge", "Detection jobs waiting to run", {}, queue_stats["queued"]),
+        ("ktamv_job_running", "gauge", "1 if a detection job is running", {}, queue_stats["running"] is not None),
+        ("ktamv_result_store_size", "gauge", "Request results kept", {}, len(request_results)),
+        ("ktamv_event_clients", "gauge", "Clients connected to /events", {}, event_bus.subscriber_count()),
+        ("ktamv_preview_running", "gauge", "1 if the preview is running", {}, preview_stats["running"]),
+        ("ktamv_preview_fps", "gauge", "Frame rate the preview runs at", {}, preview_stats["fps"]),
+        ("ktamv_preview_viewers", "gauge", "1 if someone is watching the preview", {}, frame_broadcaster.has_viewers(__VIEWER_TIMEOUT)),
+        ("ktamv_frame_version", "gauge", "Version of the last frame", {}, frame_broadcaster.version()),
+        ("ktamv_log_records", "gauge", "Log messages kept in memory", {}, len(server_log)),
+    ]
+
+
+metrics.add_collector(collect_metrics)
+
+
+# Gets, detects and shows one preview frame. Images from preview are not sent to the cloud.
+def preview_frame():
+    detection_manager = _detection_manager
+    if detection_manager is not None:
+        detection_manager.get_preview_frame(put_frame)
+
 
 ###
 # Returns the image to the web browser to act as a webcam
@@ -380,39 +670,110 @@ def preview():
 @app.route("/image")
 def image():
     try:
-        global __processed_frame_as_bytes, __update_static_image, __standby_image, __processed_frame_as_image
+        # Block until a frame newer than this version exists, for at most __IMAGE_WAIT_MAX seconds
+        since = request.args.get("since", type=int, default=None)
 
-        # If no image has been recieved since start, load a standby image
-        if __processed_frame_as_image is None:
-            __processed_frame_as_image = Image.open("standby.jpg", mode="r")
+        try:
+            preview_format = preview_format_from_args()
+        except ValueError as e:
+            return str(e), 400
+
+        # Answer 304 Not Modified if the browser already has the current frame, without rendering it
+        if since is None and request.if_none_match.contains(frame_etag(frame_broadcaster.version(), preview_format)):
+            frame_broadcaster.viewed()
+            response = Response(status=304)
+            response.set_etag(frame_etag(frame_broadcaster.version(), preview_format))
+            return response
+
+        if since is None:
+            version, data = frame_broadcaster.get(preview_format=preview_format)
+        else:
+            version, data = frame_broadcaster.get(since, __IMAGE_WAIT_MAX, preview_format)
 
-            # read the file content as bytes
-            __processed_frame_as_image.load()
-            
-            # Update text on the image
-            __update_static_image = True
+        # Send the image to the web browser
+        response = Response(data, mimetype=preview_format.mimetype)
+        response.set_etag(frame_etag(version, preview_format))
+        response.headers["X-Frame-Version"] = str(version)
+        # Browsers must ask again every time, but can use the ETag to skip the download
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    except Exception as e:
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
+
+
+# Returns the ETag of a frame version in a format. Includes the server start time so versions
+# from before a restart are never mistaken for current ones.
+def frame_etag(version, preview_format):
+    return "%d-%d-%s" % (__SERVER_STARTED, version, preview_format.tag)
+
+
+# Returns the Ktamv_Server_Preview_Format asked for in the query string of /image and /stream.
+# width: Width in pixels to scale the frame down to, the height keeps the aspect ratio
+# quality: Encoder quality from 1 to 95
+# format: jpeg or webp
+# Raises ValueError if a parameter is invalid.
+def preview_format_from_args():
+    width = request.args.get("width", type=int, default=None)
+    quality = request.args.get("quality", type=int, default=None)
+    image_format = request.args.get("format", default="jpeg").casefold()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if not Ktamv_Server_Preview_Format.supported(image_format):
+        raise ValueError("Unsupported image format: " + image_format)
+    if width is not None:
+        # Larger than the frame is the full frame, so it is encoded only once
+        width = None if width >= _FRAME_WIDTH else max(width, __PREVIEW_MIN_WIDTH)
+    if quality is not None:
+        quality = min(max(quality, 1), 95)
+    return Ktamv_Server_Preview_Format(width, quality, image_format)
 
-        if __update_static_image:
-            __update_static_image = False
+###
+# Streams the image to the web browser as MJPEG, to be used as a webcam stream
+###
+@app.route("/stream")
+def stream():
+    try:
+        try:
+            preview_format = preview_format_from_args()
+        except ValueError as e:
+            return str(e), 400
+
+        return Response(
+            frame_broadcaster.stream(__STREAM_BOUNDARY, preview_format=preview_format),
+            mimetype="multipart/x-mixed-replace; boundary=" + __STREAM_BOUNDARY,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    except Exception as e:
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
 
-            # Draw the text on the image
-            __processed_frame_as_image = drawOnFrame(__processed_frame_as_image)
 
-            # Save the image to a byte array of JPEG format
-            img_io = io.BytesIO()
-            __processed_frame_as_image.save(img_io, "JPEG")
-            img_io.seek(0)
-            __processed_frame_as_bytes = img_io.read()
-            
+# Draws the detection and the text on the last frame and returns it as a PIL Image.
+# Called by the frame broadcaster at most once for every new frame, and only when someone is watching.
+# The broadcaster encodes it in the sizes and formats the viewers ask for.
+def render_frame():
+    global __standby_image
+    frame, detection = __last_frame
 
-        # Get a byte stream of the image
-        processed_frame_file = io.BytesIO(__processed_frame_as_bytes)
-        processed_frame_file.seek(0)
+    if frame is None:
+        # If no image has been recieved since start, use a standby image
+        if __standby_image is None:
+            __standby_image = Image.open("standby.jpg", mode="r")
 
-        # Send the image to the web browser
-        return send_file(processed_frame_file, mimetype="image/jpeg")
-    except Exception as e:
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+            # read the file content as bytes
+            __standby_image.load()
+        usedFrame = __standby_image.copy()
+    else:
+        with metrics.timer("ktamv_stage_seconds", stage="render"):
+            if callable(frame):
+                frame = frame()
+            if detection is not None:
+                frame = dm.drawNozzleDetection(frame, detection)
+            # Convert the frame to a PIL Image
+            usedFrame = Image.fromarray(frame)
+
+    # Draw the text on the image
+    with metrics.timer("ktamv_stage_seconds", stage="overlay"):
+        return drawOnFrame(usedFrame)
 
 
 def drawOnFrame(usedFrame):
@@ -422,12 +783,12 @@ def drawOnFrame(usedFrame):
 
     # Draw the date on the image
     usedFrame: Image.Image = drawTextOnFrame(
-        usedFrame, "Updated: " + current_datetime_str, row=1
+        usedFrame, "Updated: " + current_datetime_str, row=1, cache=False
     )
     
     if _camera_url is None:
         usedFrame = drawTextOnFrame(usedFrame, "kTAMV Server Configuration not recieved.", row=2)
-    elif __processed_frame_as_image is None:
+    elif __last_frame[0] is None:
         usedFrame = drawTextOnFrame(usedFrame, "No image recieved since start.", row=2)
     elif _transformMatrix is None:
         usedFrame = drawTextOnFrame(usedFrame, "Camera not calibrated.", row=2)
@@ -435,58 +796,35 @@ def drawOnFrame(usedFrame):
     if __error_message_to_image != "":
         usedFrame = drawTextOnFrame(usedFrame, __error_message_to_image, row=3)
         
-    if __preview_running:
+    if preview_scheduler.is_running():
         usedFrame = drawTextOnFrame(usedFrame, "Preview running.", row=-1, row_width=270)
                 
     return usedFrame
 
-def drawTextOnFrame(usedFrame, text, row=1, row_width=640):
+# cache: Keep the rendered text for the next frame, for text that does not change every frame
+def drawTextOnFrame(usedFrame, text, row=1, row_width=640, cache=True):
     try:
-        FONT_SIZE = 28
-        FONT_COLOR = (255, 255, 255)
-        FIRST_ROW_START = (10, 10)
-
-        # Create a draw object
-        draw = ImageDraw.Draw(usedFrame)
-
-        # Choose a font
-        font_path = fm.findfont(fm.FontProperties(family="arial"))
-        font = ImageFont.truetype(font_path, FONT_SIZE)
-
-        if row > 0:
-            # Row from top
-            start_point = (FIRST_ROW_START[0], FIRST_ROW_START[1] + (row - 1) * (FONT_SIZE + 10) )
-        else:
-            # Row from bottom
-            start_point = (FIRST_ROW_START[0], usedFrame.height - (abs(row) * (FONT_SIZE + 10) + FIRST_ROW_START[1]) )
-        
-        # Draw the date on the image
-        draw.rectangle((start_point[0]-5, start_point[1]-5, row_width - start_point[0], start_point[1] + FONT_SIZE + 10), fill=(0,0,0))
-        draw.text(start_point, text, font=font, fill=FONT_COLOR )
-
-        return usedFrame
+        return overlay.draw_text(usedFrame, text, row, row_width, cache)
     except Exception as e:
-        log("Error: " + str(e) + "<br>" + str(traceback.format_exc()))
+        log("Error: " + str(e) + "\n" + str(traceback.format_exc()), level=logging.ERROR)
 
 
 def log_clear():
-    global __logdebug
-    __logdebug = ""
-
-
-def log(message: str):
-    global __logdebug
-    __logdebug += message + "<br>"
+    server_log.clear()
 
 
-def log_get():
-    global __logdebug
-    return __logdebug
+# Logs the message at the level, formatted with the args only if the level is logged.
+# Use args instead of formatting the message in code that runs for every frame.
+def log(message: str, *args, level = logging.DEBUG):
+    server_log.log(message, *args, level=level)
 
+# The frame is only drawn again if the message changed
 def show_error_message_to_image(message : str):
-    global __error_message_to_image, __update_static_image
+    global __error_message_to_image
+    if message == __error_message_to_image:
+        return
     __error_message_to_image = message
-    __update_static_image = True
+    frame_broadcaster.invalidate()
 
 # Run the app on the specified port
 if __name__ == "__main__":
@@ -495,11 +833,17 @@ if __name__ == "__main__":
     # Create an argument parser
     parser = ArgumentParser()
     parser.add_argument("--port", type=int, default=8085, help="Port number")
+    # Every open /events or /stream connection and waiting getReqest uses one thread
+    parser.add_argument("--threads", type=int, default=16, help="Number of threads serving requests")
+    parser.add_argument("--log-level", default=__LOG_LEVEL, help="Lowest level of messages logged: DEBUG, INFO, WARNING or ERROR")
 
     # Parse the command-line arguments
     args = parser.parse_args()
+    server_log.set_level(args.log_level)
 
     # Run the app with the specified port
     # app.run(host="0.0.0.0", port=args.port, debug=True)
     # app.run(host='0.0.0.0', port=args.port, debug=False)
-    serve(app, host='0.0.0.0', port=args.port)
+    # A small output buffer per connection makes a slow /stream viewer wait for the newest frame
+    # instead of the server queueing up old frames for it
+    serve(app, host='0.0.0.0', port=args.port, threads=args.threads, outbuf_high_watermark=256 * 1024)
@@ -1,96 +1,269 @@
-import copy, time, cv2, numpy as np
+import logging, time, os, threading, cv2, numpy as np
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from ktamv_server_io import Ktamv_Server_Io as io
+from ktamv_server_preprocess import Ktamv_Server_Preprocessor
+from ktamv_server_metrics import metrics
+
+
+@dataclass
+class Ktamv_Server_Detection:
+    # The result of detecting the nozzle in one frame, kept to draw it on the frame later
+    center: tuple = None  # (x, y) in the full frame, None if no nozzle was found
+    radius: int = None
+    color: tuple = None   # Color of the combo that found it
 
 
 class Ktamv_Server_Detection_Manager:
     uv = [None, None]
     __algorithm = None
     __io = None
+
+    # The detector and preprocessor combos tried in order by nozzleDetection,
+    # with the color used to mark the keypoint found by each combo.
+    __COMBOS = (
+        ("detector", 0, (0,0,255)),                 # combo 1 (standard detector, preprocessor 0)
+        ("detector", 1, (0,255,0)),                 # combo 2 (standard detector, preprocessor 1)
+        ("relaxedDetector", 0, (255,0,0)),          # combo 3 (relaxed detector, preprocessor 0)
+        ("relaxedDetector", 1, (39,127,255)),       # combo 4 (relaxed detector, preprocessor 1)
+        ("superRelaxedDetector", 2, (39,255,127)),  # combo 5 (superrelaxed detector, preprocessor 2)
+    )
+
+    # The parameters each detector is created from, used to give every combo its own detector when running in parallel
+    __DETECTOR_PARAMS = {
+        "detector": "standardParams",
+        "relaxedDetector": "relaxedParams",
+        "superRelaxedDetector": "superRelaxedParams",
+    }
+
+    # Window sizes searched around the last position when tracking, before the whole frame.
+    # The smallest one still fits the largest blob the relaxed detector accepts.
+    __TRACKING_WINDOWS = ((240, 180), (400, 300))
+    # Pixels a keypoint must keep from a window edge to be trusted
+    __TRACKING_MARGIN = 4
     
     ##### Setup functions
     # init function
-    def __init__(self, log, camera_url, cloud_url, send_to_cloud = False, *args, **kwargs):
+    # parallel: Run the detector combos at the same time on a thread pool instead of one after another
+    # max_workers: Maximum threads used when running in parallel, defaults to the number of CPUs
+    # grayscale: Decode camera frames without color for detection, the preview gets color only when drawn.
+    #            Faster, but it can change which nozzle is found, as gamma is applied to the gray image instead of to every color.
+    # log_enabled: Function returning True if log messages of a level are kept, to skip building costly messages
+    def __init__(self, log, camera_url, cloud_url, send_to_cloud = False, parallel = False, max_workers = None, grayscale = False, log_enabled = None, *args, **kwargs):
         try:
             self.log = log
+            self.log_enabled = log_enabled if log_enabled is not None else lambda level: True
 
             # send calling to log
             self.log('*** calling DetectionManager.__init__')
             
             # Whether to send the images to the cloud after detection.
             self.send_to_cloud = send_to_cloud
+
+            # The camera this detection manager reads from.
+            self.camera_url = camera_url
+
+            # Whether to detect on grayscale frames
+            self.grayscale = grayscale
             
             # The already initialized io object.
             self.__io = io(log=log, camera_url=camera_url, cloud_url=cloud_url, save_image=False)
             
-            # This is the last successful algorithm used by the nozzle detection. Should be reset at tool change. Will have to change.
+            # This is the last successful algorithm used by the nozzle detection for the current tool.
             self.__algorithm = None
 
+            # The tool currently over the camera, the cascade learns separately for every tool.
+            self.__tool = None
+            # Last successful combo and [hits, misses] of every combo, per tool.
+            self.__last_combo = {}
+            self.__combo_stats = {}
+
+            # Last detected nozzle position in the full frame, used as center of the tracking window.
+            self.__tracking_position = None
+
+            # Held while a detection job or a preview frame uses the camera and detectors
+            self.__lock = threading.RLock()
+            # Set when the detection manager is closed, a running detection stops at its next frame
+            self.__closed = threading.Event()
+
+            # Preprocesses frames into buffers reused from frame to frame
+            self.__preprocessor = Ktamv_Server_Preprocessor()
+
+            # Whether to evaluate the combos in parallel and the thread pool used for it
+            self.parallel = parallel
+            self.__executor = None
+            # Preprocessor and combo detectors of every frame in flight when running in parallel, as
+            # (preprocessor, detectors). A frame takes a free set, so combos ignored on the last frame,
+            # still reading its images, do not hold it up. Busy sets are kept with the futures of their combos.
+            self.__free_lanes = []
+            self.__busy_lanes = []
+            if parallel:
+                workers = max_workers or min(os.cpu_count() or 1, len(self.__COMBOS))
+                self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ktamv-detect")
+
             # TAMV has 2 detectors, one for standard and one for relaxed
             self.createDetectors()
             
             # send exiting to log
             self.log('*** exiting DetectionManager.__init__')
         except Exception as e:
-            self.log('*** exception in DetectionManager.__init__: %s' % str(e))
+            self.log('*** exception in DetectionManager.__init__: %s', e, level=logging.ERROR)
             raise e
 
     # timeout = 20: If no nozzle found in this time, timeout the function
     # min_matches = 3: Minimum amount of matches to confirm toolhead position after a move
     # xy_tolerance = 1: If the nozzle position is within this tolerance, it's considered a match. 1.0 would be 1 pixel. Only whole numbers are supported.
-    # put_frame_func: Function to put the frame into the main program
-    def recursively_find_nozzle_position(self, put_frame_func, min_matches, timeout, xy_tolerance):
-        self.log('*** calling recursively_find_nozzle_position')
-        start_time = time.time()  # Get the current time
-        last_pos = (0,0)
-        pos_matches = 0
-        pos = None
-
-        while time.time() - start_time < timeout:
-            frame = self.__io.get_single_frame()
-            positions, processed_frame = self.nozzleDetection(frame)
-            if processed_frame is not None:
-                put_frame_func(processed_frame)
-
-            self.log('recursively_find_nozzle_position positions: %s' % str(positions))
-
-            if positions is None or len(positions) == 0:
-                continue
+    # put_frame_func: Function to put the frame, the detection in it and the frame time stamp into the main program.
+    #                 The frame is not drawn on, that is left to when someone wants to see it.
+    # captured_after: Only use frames that arrived after this time.time() value, i.e. after the last move finished
+    # should_stop: Function returning True when nobody waits for the position anymore, stops looking early
+    def recursively_find_nozzle_position(self, put_frame_func, min_matches, timeout, xy_tolerance, captured_after = None, should_stop = None):
+        # Only one job or preview frame uses the camera and detectors at a time
+        with self.__lock:
+            self.log('*** calling recursively_find_nozzle_position')
+            start_time = time.time()  # Get the current time
+            last_pos = (0,0)
+            pos_matches = 0
+            pos = None
 
-            pos = positions
-            # Only compare XY position, not radius...
-            if abs(pos[0] - last_pos[0]) <= xy_tolerance and abs(pos[1] - last_pos[1]) <= xy_tolerance:
-                pos_matches += 1
-                if pos_matches >= min_matches:
-                    self.log("recursively_find_nozzle_position found %i matches and returning" % pos_matches)
-                    # Send the frame and detection to the cloud if enabled.
-                    if self.send_to_cloud:
-                        self.__io.send_frame_to_cloud(frame, pos, self.__algorithm)
+            while time.time() - start_time < timeout:
+                if self.__closed.is_set():
+                    self.log("recursively_find_nozzle_position stopped, the detection manager was closed", level=logging.INFO)
                     break
-            else:
-                self.log("Position found does not match last position. Last position: %s, current position: %s" % (str(last_pos), str(pos)))   
-                self.log("Difference: X%.3f Y%.3f" % (abs(pos[0] - last_pos[0]), abs(pos[1] - last_pos[1])))
-                pos_matches = 0
+                if should_stop is not None and should_stop():
+                    self.log("recursively_find_nozzle_position stopped, nobody waits for the position", level=logging.INFO)
+                    break
+                # The first frame must be taken after the move, the following ones are always newer than the last
+                frame = self.__io.get_single_frame(captured_after, self.grayscale)
+                captured_after = None
+                if frame is None:
+                    continue
+                metrics.inc("ktamv_frames_processed_total", kind="job")
+                detection = self.detectNozzle(frame, tracking=True)
+                positions = detection.center
+                put_frame_func(self.__preview_frame(frame), detection, self.__io.last_frame_time)
+
+                self.log('recursively_find_nozzle_position positions: %s', positions)
 
-            last_pos = pos
-            # Wait 0.3 to leave time for the webcam server to catch up
-            # Crowsnest usually caches 0.3 seconds of frames
-            time.sleep(0.3)
+                if positions is None or len(positions) == 0:
+                    metrics.job_count("frames_without_nozzle")
+                    continue
+
+                pos = positions
+                # Only compare XY position, not radius...
+                if abs(pos[0] - last_pos[0]) <= xy_tolerance and abs(pos[1] - last_pos[1]) <= xy_tolerance:
+                    pos_matches += 1
+                    if pos_matches >= min_matches:
+                        self.log("recursively_find_nozzle_position found %i matches and returning", pos_matches)
+                        # Send the frame and detection to the cloud if enabled.
+                        if self.send_to_cloud:
+                            self.__io.send_frame_to_cloud(frame, pos, self.__algorithm)
+                        break
+                else:
+                    # Start a new consensus round, counting matches again from this position
+                    metrics.job_count("consensus_rounds")
+                    self.log("Position found does not match last position. Last position: %s, current position: %s", last_pos, pos)
+                    self.log("Difference: X%.3f Y%.3f", abs(pos[0] - last_pos[0]), abs(pos[1] - last_pos[1]))
+                    pos_matches = 0
 
-        self.log("recursively_find_nozzle_position found: %s" % str(last_pos))
-        self.log('*** exiting recursively_find_nozzle_position')
-        return pos
+                last_pos = pos
+
+            if self.log_enabled(logging.DEBUG):
+                self.log("recursively_find_nozzle_position cascade stats: %s", self.get_cascade_stats())
+            self.log("recursively_find_nozzle_position found: %s", last_pos, level=logging.INFO)
+            self.log('*** exiting recursively_find_nozzle_position')
+            return pos
 
     def get_preview_frame(self, put_frame_func):
         # self.log('*** calling get_preview_frame')
 
-        frame = self.__io.get_single_frame()
-        _, processed_frame = self.nozzleDetection(frame)
-        if processed_frame is not None:
-            put_frame_func(processed_frame)
+        with self.__lock:
+            if self.__closed.is_set():
+                return
+            frame = self.__io.get_single_frame(grayscale=self.grayscale)
+            if frame is None:
+                return
+            metrics.inc("ktamv_frames_processed_total", kind="preview")
+            detection = self.detectNozzle(frame)
+            put_frame_func(self.__preview_frame(frame), detection, self.__io.last_frame_time)
 
         # self.log('*** exiting get_preview_frame')
         return
 
+    # Returns the frame to show on the preview: the frame itself if in color, otherwise
+    # a function decoding it in color, called only if someone looks at the preview
+    def __preview_frame(self, frame):
+        return self.__io.color_loader() if frame.ndim == 2 else frame
+
+    # Starts reading from the camera so the first detection does not wait for the connection
+    def open_stream(self):
+        self.__io.open_stream()
+
+    # Sets the tool that is over the camera. The cascade starts with the combo that last worked for it.
+    # Tracking starts over, the new nozzle is searched in the whole frame.
+    def set_tool(self, tool):
+        with self.__lock:
+            self.__tool = tool
+            self.__algorithm = self.__last_combo.get(tool)
+            self.__tracking_position = None
+
+    # Returns the hit and miss counters of every combo, per tool.
+    # Called from other threads while a job counts, so it works on copies.
+    def get_cascade_stats(self):
+        stats = {}
+        for tool, combo_stats in list(self.__combo_stats.items()):
+            stats[str(tool)] = {
+                "last_combo": self.__last_combo.get(tool),
+                "combos": {
+                    combo: {"hits": hits, "misses": misses}
+                    for combo, (hits, misses) in enumerate([list(counts) for counts in combo_stats], start=1)
+                },
+            }
+        return stats
+
+    # Returns the combo numbers in the order to try them for the current tool.
+    # The combo that last succeeded goes first, the rest are ordered by their hit rate.
+    # Combos not yet tried count as a 50% hit rate, ties keep the original priority.
+    def __combo_order(self):
+        combo_stats = self.__combo_stats.get(self.__tool)
+        if combo_stats is None:
+            return list(range(1, len(self.__COMBOS) + 1))
+        order = sorted(
+            range(1, len(self.__COMBOS) + 1),
+            key=lambda combo: -(combo_stats[combo - 1][0] + 1) / (sum(combo_stats[combo - 1]) + 2),
+        )
+        last_combo = self.__last_combo.get(self.__tool)
+        if last_combo is not None:
+            order.remove(last_combo)
+            order.insert(0, last_combo)
+        return order
+
+    # Counts the (combo, hit) results of the combos run on a frame
+    def __count_combos(self, results):
+        combo_stats = self.__combo_stats.setdefault(self.__tool, [[0, 0] for _ in self.__COMBOS])
+        for combo, hit in results:
+            combo_stats[combo - 1][0 if hit else 1] += 1
+            metrics.inc("ktamv_cascade_total", combo=combo, result="hit" if hit else "miss")
+            if hit:
+                self.__last_combo[self.__tool] = combo
+                self.__algorithm = combo
+
+    # Closes the camera stream. Must be called when the detection manager is no longer used.
+    # A running detection stops at its next frame, the stream is closed once it has.
+    # wait: Return when closed, otherwise close in the background without waiting for the detection
+    def close(self, wait = True):
+        self.__closed.set()
+        if wait:
+            self.__close()
+        else:
+            threading.Thread(target=self.__close, name="ktamv-close-detection", daemon=True).start()
+
+    def __close(self):
+        with self.__lock:
+            self.__io.close_stream()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
+
 # ----------------- TAMV Nozzle Detection as tested in ktamv_cv -----------------
 
     def createDetectors(self):
@@ -172,70 +345,32 @@ class Ktamv_Server_Detection_Manager:
         self.relaxedDetector = cv2.SimpleBlobDetector_create(self.relaxedParams)
         self.superRelaxedDetector = cv2.SimpleBlobDetector_create(self.superRelaxedParams)
 
-    def nozzleDetection(self, image):
-        # working frame object
-        nozzleDetectFrame = copy.deepcopy(image)
-        # return value for keypoints
-        keypoints = None
-        center = (None, None)
-        # check which algorithm worked previously
-        if 1==1: #(self.__algorithm is None):
-            preprocessorImage0 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=0)
-            preprocessorImage1 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=1)
-            preprocessorImage2 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=2)
-
-            # apply combo 1 (standard detector, preprocessor 0)
-            keypoints = self.detector.detect(preprocessorImage0)
-            keypointColor = (0,0,255)
-            if(len(keypoints) != 1):
-                # apply combo 2 (standard detector, preprocessor 1)
-                keypoints = self.detector.detect(preprocessorImage1)
-                keypointColor = (0,255,0)
-                if(len(keypoints) != 1):
-                    # apply combo 3 (relaxed detector, preprocessor 0)
-                    keypoints = self.relaxedDetector.detect(preprocessorImage0)
-                    keypointColor = (255,0,0)
-                    if(len(keypoints) != 1):
-                        # apply combo 4 (relaxed detector, preprocessor 1)
-                        keypoints = self.relaxedDetector.detect(preprocessorImage1)
-                        keypointColor = (39,127,255)
-
-                        if(len(keypoints) != 1):
-                            # apply combo 5 (superrelaxed detector, preprocessor 2)
-                            keypoints = self.superRelaxedDetector.detect(preprocessorImage2)
-                            keypointColor = (39,255,127)
-                            if(len(keypoints) != 1):
-                                # failed to detect a nozzle, correct return value object
-                                keypoints = None
-                            else:
-                                self.__algorithm = 5
-                        else:
-                            self.__algorithm = 4
-                    else:
-                        self.__algorithm = 3
-                else:
-                    self.__algorithm = 2
-            else:
-                self.__algorithm = 1
-        elif(self.__algorithm == 1):
-            preprocessorImage0 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=0)
-            keypoints = self.detector.detect(preprocessorImage0)
-            keypointColor = (0,0,255)
-        elif(self.__algorithm == 2):
-            preprocessorImage1 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=1)
-            keypoints = self.detector.detect(preprocessorImage1)
-            keypointColor = (0,255,0)
-        elif(self.__algorithm == 3):
-            preprocessorImage0 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=0)
-            keypoints = self.relaxedDetector.detect(preprocessorImage0)
-            keypointColor = (255,0,0)
-        else:
-            preprocessorImage1 = self.preprocessImage(frameInput=nozzleDetectFrame, algorithm=1)
-            keypoints = self.relaxedDetector.detect(preprocessorImage1)
-            keypointColor = (39,127,255)
-            
+        if self.parallel:
+            self.__free_lanes = [(Ktamv_Server_Preprocessor(), self.__create_combo_detectors())]
+            self.__busy_lanes = []
+
+    # A blob detector keeps state while detecting, so combos running in parallel get one each
+    def __create_combo_detectors(self):
+        return [
+            cv2.SimpleBlobDetector_create(getattr(self, self.__DETECTOR_PARAMS[detector]))
+            for detector, _, _ in self.__COMBOS
+        ]
+
+    # Detects the nozzle and returns its center and a copy of the frame with the detection drawn on it
+    # tracking: Search a window around the last detected position first, growing it up to the whole frame on a miss
+    def nozzleDetection(self, image, tracking = False):
+        detection = self.detectNozzle(image, tracking)
+        return(detection.center, self.drawNozzleDetection(image, detection))
+
+    # Detects the nozzle without drawing anything, the frame itself is left as it is
+    # tracking: Search a window around the last detected position first, growing it up to the whole frame on a miss
+    def detectNozzle(self, image, tracking = False):
+        # Keypoint coordinates are relative to the searched window, offset gives them in the full frame
+        with metrics.timer("ktamv_stage_seconds", span="detect", stage="detect"):
+            keypoints, keypointColor, offset = self.__detect_in_windows(image, tracking)
+
         if keypoints is not None:
-            self.log("Nozzle detected %i circles with algorithm: %s" % (len(keypoints), str(self.__algorithm)))
+            self.log("Nozzle detected %i circles with algorithm: %s", len(keypoints), self.__algorithm)
         else:
             self.log("Nozzle detection failed.")
             
@@ -252,12 +387,23 @@ class Ktamv_Server_Detection_Manager:
                 # create center object from first and only keypoint
                 (x,y) = np.around(keypoints[0].pt)
             
-            x,y = int(x), int(y)
-            center = (x,y)
+            x,y = int(x) + offset[0], int(y) + offset[1]
             # create radius object
             keypointRadius = np.around(keypoints[0].size/2)
             keypointRadius = int(keypointRadius)
-            circleFrame = cv2.circle(img=nozzleDetectFrame, center=center, radius=keypointRadius,color=keypointColor,thickness=-1,lineType=cv2.LINE_AA)
+            return Ktamv_Server_Detection((x,y), keypointRadius, keypointColor)
+        return Ktamv_Server_Detection()
+
+    # Returns a copy of the frame with the detected nozzle, or the missing nozzle marker, and the crosshair drawn on it
+    @staticmethod
+    def drawNozzleDetection(image, detection):
+        # working frame object, the frame itself is left as it is
+        nozzleDetectFrame = image.copy()
+        if detection.center is not None:
+            center = detection.center
+            x, y = center
+            keypointRadius = detection.radius
+            circleFrame = cv2.circle(img=nozzleDetectFrame, center=center, radius=keypointRadius,color=detection.color,thickness=-1,lineType=cv2.LINE_AA)
             nozzleDetectFrame = cv2.addWeighted(circleFrame, 0.4, nozzleDetectFrame, 0.6, 0)
             nozzleDetectFrame = cv2.circle(img=nozzleDetectFrame, center=center, radius=keypointRadius, color=(0,0,0), thickness=1,lineType=cv2.LINE_AA)
             nozzleDetectFrame = cv2.line(nozzleDetectFrame, (x-5,y), (x+5, y), (255,255,255), 2)
@@ -267,38 +413,141 @@ class Ktamv_Server_Detection_Manager:
             keypointRadius = 17
             nozzleDetectFrame = cv2.circle(img=nozzleDetectFrame, center=(320,240), radius=keypointRadius, color=(0,0,0), thickness=3,lineType=cv2.LINE_AA)
             nozzleDetectFrame = cv2.circle(img=nozzleDetectFrame, center=(320,240), radius=keypointRadius+1, color=(0,0,255), thickness=1,lineType=cv2.LINE_AA)
-            center = None
         # draw crosshair
         nozzleDetectFrame = cv2.line(nozzleDetectFrame, (320,0), (320,480), (0,0,0), 2)
         nozzleDetectFrame = cv2.line(nozzleDetectFrame, (0,240), (640,240), (0,0,0), 2)
         nozzleDetectFrame = cv2.line(nozzleDetectFrame, (320,0), (320,480), (255,255,255), 1)
         nozzleDetectFrame = cv2.line(nozzleDetectFrame, (0,240), (640,240), (255,255,255), 1)
 
-        # return(center, nozzleDetectFrame)
-        return(center, nozzleDetectFrame)
+        return nozzleDetectFrame
 
-    # Image detection preprocessors
-    def preprocessImage(self, frameInput, algorithm=0):
-        try:
-            outputFrame = self.adjust_gamma(image=frameInput, gamma=1.2)
-            height, width, channels = outputFrame.shape
-        except: outputFrame = copy.deepcopy(frameInput)
-        if(algorithm == 0):
-            yuv = cv2.cvtColor(outputFrame, cv2.COLOR_BGR2YUV)
-            yuvPlanes = cv2.split(yuv)
-            yuvPlanes_0 = cv2.GaussianBlur(yuvPlanes[0],(7,7),6)
-            yuvPlanes_0 = cv2.adaptiveThreshold(yuvPlanes_0,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,35,1)
-            outputFrame = cv2.cvtColor(yuvPlanes_0,cv2.COLOR_GRAY2BGR)
-        elif(algorithm == 1):
-            outputFrame = cv2.cvtColor(outputFrame, cv2.COLOR_BGR2GRAY )
-            thr_val, outputFrame = cv2.threshold(outputFrame, 127, 255, cv2.THRESH_BINARY|cv2.THRESH_TRIANGLE )
-            outputFrame = cv2.GaussianBlur( outputFrame, (7,7), 6 )
-            outputFrame = cv2.cvtColor( outputFrame, cv2.COLOR_GRAY2BGR )
-        elif(algorithm == 2):
-            gray = cv2.cvtColor(frameInput, cv2.COLOR_BGR2GRAY)
-            outputFrame = cv2.medianBlur(gray, 5)
-
-        return(outputFrame)
+    # Returns the keypoints, their color and the (x, y) offset of the window they were found in.
+    # When tracking, windows around the last position are searched before the whole frame.
+    # Only the combos run on the window giving the result, or on the whole frame, count for the cascade.
+    def __detect_in_windows(self, frame, tracking):
+        height, width = frame.shape[:2]
+        full_frame = (0, 0, width, height)
+        windows = []
+        if tracking and self.__tracking_position is not None:
+            for window_width, window_height in self.__TRACKING_WINDOWS:
+                if window_width < width and window_height < height:
+                    windows.append(self.__tracking_window(window_width, window_height, width, height))
+        windows.append(full_frame)
+
+        keypoints, keypointColor = None, None
+        for window in windows:
+            x0, y0, x1, y1 = window
+            keypoints, keypointColor, results = self.__detect_keypoints(frame[y0:y1, x0:x1])
+            if keypoints is None:
+                if window == full_frame:
+                    self.__count_combos(results)
+                continue
+            # A nozzle cut by the window edge is not trusted, a larger window is tried instead
+            if window != full_frame and not self.__inside_window(keypoints[0], window, width, height):
+                continue
+            self.__count_combos(results)
+            if tracking:
+                x, y = keypoints[0].pt
+                self.__tracking_position = (int(round(x)) + x0, int(round(y)) + y0)
+            if window != full_frame:
+                self.log("Nozzle found in tracking window %s", window)
+            return keypoints, keypointColor, (x0, y0)
+        if tracking:
+            # Lost the nozzle, do not search around where it was
+            self.__tracking_position = None
+        return None, keypointColor, (0, 0)
+
+    # Returns a window of the given size centered on the last position, moved to stay inside the frame
+    def __tracking_window(self, window_width, window_height, width, height):
+        x0 = min(max(self.__tracking_position[0] - window_width // 2, 0), width - window_width)
+        y0 = min(max(self.__tracking_position[1] - window_height // 2, 0), height - window_height)
+        return (x0, y0, x0 + window_width, y0 + window_height)
+
+    # Returns True if the keypoint is not touching an edge of the window that is not also a frame edge
+    def __inside_window(self, keypoint, window, width, height):
+        x0, y0, x1, y1 = window
+        x, y = keypoint.pt
+        radius = keypoint.size / 2 + self.__TRACKING_MARGIN
+        return ((x0 == 0 or x - radius >= 0) and (y0 == 0 or y - radius >= 0)
+            and (x1 == width or x + radius <= x1 - x0) and (y1 == height or y + radius <= y1 - y0))
+
+    # Runs the detector cascade on the frame and returns the keypoints and their color, or None if no nozzle was found,
+    # and a list of (combo, hit) of the combos run, in order
+    def __detect_keypoints(self, frame):
+        if self.parallel:
+            lane = self.__take_lane()
+            preprocessor = lane[0]
+        else:
+            preprocessor = self.__preprocessor
+        # Preprocessed images are only computed when a detector first needs them
+        preprocessed = Ktamv_Server_Preprocessed_Frame(preprocessor, frame)
+        if self.parallel:
+            keypoints, keypointColor, results = self.__detect_keypoints_parallel(preprocessed, lane)
+        else:
+            # Try the combo that worked last time first, then the rest by their hit rate.
+            # If all fail, the whole cascade has been tried.
+            keypointColor = None
+            results = []
+            for algorithm in self.__combo_order():
+                detector, preprocessor, color = self.__COMBOS[algorithm - 1]
+                # apply the combo and stop at the first one finding exactly one keypoint
+                image = preprocessed.get(preprocessor)
+                with metrics.timer("ktamv_combo_seconds", span="combo_%d" % algorithm, combo=algorithm):
+                    keypoints = getattr(self, detector).detect(image)
+                keypointColor = color
+                results.append((algorithm, len(keypoints) == 1))
+                if(len(keypoints) == 1):
+                    break
+            else:
+                # failed to detect a nozzle, correct return value object
+                keypoints = None
+            # Combos running in parallel compute the stages they need while this is read, so it is only logged here
+            self.log("Nozzle detection ran %i of 3 preprocessing stages.", preprocessed.stages_run)
+
+        return keypoints, keypointColor, results
+
+    # Runs all combos on the thread pool and returns the same result as the serial cascade:
+    # the first combo in order that finds exactly one keypoint. Combos later in the order
+    # are cancelled if not yet started, or their result is ignored.
+    # lane: The (preprocessor, detectors) of this frame, busy until all its combos have finished
+    def __detect_keypoints_parallel(self, preprocessed, lane):
+        detectors = lane[1]
+        # The combos run on other threads, their time is added to the timeline of the job
+        timeline = metrics.current_timeline()
+
+        def run_combo(algorithm):
+            with metrics.timeline(timeline):
+                _, preprocessor, _ = self.__COMBOS[algorithm - 1]
+                image = preprocessed.get(preprocessor)
+                with metrics.timer("ktamv_combo_seconds", span="combo_%d" % algorithm, combo=algorithm):
+                    return detectors[algorithm - 1].detect(image)
+
+        futures = [(algorithm, self.__executor.submit(run_combo, algorithm)) for algorithm in self.__combo_order()]
+        self.__busy_lanes.append((lane, futures))
+        keypoints, keypointColor, results = None, None, []
+        for i, (algorithm, future) in enumerate(futures):
+            result = future.result()
+            keypointColor = self.__COMBOS[algorithm - 1][2]
+            results.append((algorithm, len(result) == 1))
+            if len(result) == 1:
+                keypoints = result
+                for _, later in futures[i + 1:]:
+                    later.cancel()
+                break
+        return keypoints, keypointColor, results
+
+    # Returns a (preprocessor, detectors) no combo is using anymore, a new one if all are busy
+    def __take_lane(self):
+        busy_lanes = []
+        for lane, futures in self.__busy_lanes:
+            if all(future.done() for _, future in futures):
+                self.__free_lanes.append(lane)
+            else:
+                busy_lanes.append((lane, futures))
+        self.__busy_lanes = busy_lanes
+        if self.__free_lanes:
+            return self.__free_lanes.pop()
+        return Ktamv_Server_Preprocessor(), self.__create_combo_detectors()
 
     def find_closest_keypoint(keypoints):
         closest_index = None
@@ -315,12 +564,38 @@ class Ktamv_Server_Detection_Manager:
 
         return closest_index
 
-    def adjust_gamma(self, image, gamma=1.2):
-        # build a lookup table mapping the pixel values [0, 255] to
-        # their adjusted gamma values
-        invGamma = 1.0 / gamma
-        table = np.array([((i / 255.0) ** invGamma) * 255
-            for i in np.arange(0, 256)]).astype( 'uint8' )
-        # apply gamma correction using the lookup table
-        return cv2.LUT(image, table)
 
+class Ktamv_Server_Preprocessed_Frame:
+    # Holds the preprocessed images of one frame. Each image is computed the first time a
+    # detector asks for it and then reused. The gamma corrected frame is shared by
+    # preprocessors 0 and 1, preprocessor 2 works on the frame as it is.
+    # Safe to use from the combos running in parallel, each image is still only computed once.
+    def __init__(self, preprocessor, frame):
+        self.__preprocessor = preprocessor
+        self.frame = frame
+        self.__gamma = None
+        self.__images = {}
+        self.__gamma_lock = threading.Lock()
+        self.__locks = {0: threading.Lock(), 1: threading.Lock(), 2: threading.Lock()}
+        # Amount of preprocessing stages that actually ran for this frame, only exact when used from one thread
+        self.stages_run = 0
+
+    def get(self, algorithm):
+        image = self.__images.get(algorithm)
+        if image is None:
+            with self.__locks[algorithm]:
+                image = self.__images.get(algorithm)
+                if image is None:
+                    gamma = None
+                    if algorithm != 2:
+                        gamma = self.__get_gamma()
+                    image = self.__preprocessor.preprocess(self.frame, algorithm, gamma)
+                    self.__images[algorithm] = image
+                    self.stages_run += 1
+        return image
+
+    def __get_gamma(self):
+        with self.__gamma_lock:
+            if self.__gamma is None:
+                self.__gamma = self.__preprocessor.gamma(self.frame)
+            return self.__gamma
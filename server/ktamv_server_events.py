@@ -0,0 +1,71 @@
+import itertools, json, queue, threading, time
+
+
+class Ktamv_Server_Event_Bus:
+    # Fans out server events to every connected Server-Sent Events client.
+    # Every client gets its own bounded queue. A client not keeping up loses its
+    # oldest events instead of slowing down the detection that publishes them.
+
+    # max_queue: Maximum events waiting to be sent to one client
+    def __init__(self, max_queue = 100):
+        self.max_queue = max_queue
+        # Queue of every client -> the event types it wants, None for all
+        self.__subscribers = {}
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count(1)
+
+    # Returns the amount of connected clients
+    def subscriber_count(self):
+        with self.__lock:
+            return len(self.__subscribers)
+
+    # Sends an event to all clients. data must be JSON serializable.
+    def publish(self, event_type, data):
+        with self.__lock:
+            if not self.__subscribers:
+                return
+            subscribers = [
+                subscriber for subscriber, event_types in self.__subscribers.items()
+                if event_types is None or event_type in event_types
+            ]
+            if not subscribers:
+                return
+            event = (next(self.__ids), event_type, json.dumps(data))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # Drop the oldest event to make room for the newest
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    subscriber.put_nowait(event)
+                except queue.Full:
+                    pass
+
+    # Returns a generator of Server-Sent Events text for one client.
+    # event_types: Only send events of these types, all if None
+    # keepalive: Seconds between comments sent to keep the connection open when there are no events
+    def stream(self, event_types = None, keepalive = 15):
+        subscriber = queue.Queue(maxsize=self.max_queue)
+        with self.__lock:
+            self.__subscribers[subscriber] = None if event_types is None else set(event_types)
+
+        def generate():
+            try:
+                # Tell the client how long to wait before reconnecting
+                yield "retry: 2000\n\n"
+                while True:
+                    try:
+                        event_id, event_type, data = subscriber.get(timeout=keepalive)
+                    except queue.Empty:
+                        yield ": keepalive %d\n\n" % int(time.time())
+                        continue
+                    yield "id: %d\nevent: %s\ndata: %s\n\n" % (event_id, event_type, data)
+            finally:
+                with self.__lock:
+                    self.__subscribers.pop(subscriber, None)
+
+        return generate()
@@ -1,12 +1,67 @@
-import cv2, numpy as np
+import logging, cv2, numpy as np
 import requests
 from requests.exceptions import InvalidURL, ConnectionError # , HTTPError, RequestException
-
-import base64
+from ktamv_server_sources import create_frame_source
+from ktamv_server_metrics import metrics
+from ktamv_server_upload import Ktamv_Server_Cloud_Uploader
 
 # Size of frame to use
 _FRAME_WIDTH = 640
 _FRAME_HEIGHT = 480
+# Seconds to wait for the camera to deliver a new frame
+_FRAME_TIMEOUT = 5
+# Scale factors libjpeg can decode at directly, by skipping DCT coefficients, and their imdecode flags as (color, grayscale)
+_REDUCED_DECODE = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+# JPEG start of frame markers, holding the image size
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+# Returns the (width, height) of a JPEG from its header without decoding it, or None if not found
+def jpeg_size(jpg):
+    i, n = 2, len(jpg)
+    while i + 9 < n:
+        if jpg[i] != 0xFF:
+            return None
+        marker = jpg[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Markers without a length
+            i += 2
+            continue
+        if marker in _JPEG_SOF:
+            return (jpg[i + 7] << 8) | jpg[i + 8], (jpg[i + 5] << 8) | jpg[i + 6]
+        i += 2 + ((jpg[i + 2] << 8) | jpg[i + 3])
+    return None
+
+
+# Decodes the JPEG in color or grayscale and returns it in the frame size used.
+# Frames that are an integer multiple of at least twice the frame size are decoded directly
+# at a reduced size, which is much faster than decoding at full size and resizing.
+def decode_frame(jpg, grayscale = False):
+    flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    size = jpeg_size(jpg)
+    if size is not None:
+        width, height = size
+        for factor, color_flag, gray_flag in _REDUCED_DECODE:
+            if (
+                width % factor == 0 and height % factor == 0
+                and width // factor >= _FRAME_WIDTH and height // factor >= _FRAME_HEIGHT
+            ):
+                flag = gray_flag if grayscale else color_flag
+                break
+    with metrics.timer("ktamv_stage_seconds", span="decode", stage="decode"):
+        image = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), flag)
+    if image is None or (image.shape[1] == _FRAME_WIDTH and image.shape[0] == _FRAME_HEIGHT):
+        return image
+    with metrics.timer("ktamv_stage_seconds", span="resize", stage="resize"):
+        return cv2.resize(image, (_FRAME_WIDTH, _FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
  
 class Ktamv_Server_Io:
     def __init__(self, log, camera_url, cloud_url, save_image = False):
@@ -16,7 +71,19 @@ class Ktamv_Server_Io:
         self.save_image = save_image
         self.cloud_url = cloud_url
         self.session = requests.Session()
-        self.log(' *** initialized Ktamv_Server_Io with camera_url = %s, save_image = %s **** ' % (str(camera_url), str(save_image)))
+        # Long-lived frame source, keeping the camera stream open between frames and
+        # between requests, until the stream is closed
+        self.reader = create_frame_source(log, camera_url, idle_timeout=None)
+        # Sequence number of the last frame returned, so the same frame is not returned twice
+        self.__last_sequence = 0
+        # Time stamp of the last frame returned
+        self.last_frame_time = None
+        # The last frame returned and its JPEG bytes from the camera
+        self.__last_frame = None
+        self.__last_jpeg = None
+        # Sends frames to the cloud in the background, created when the first frame is sent
+        self.__uploader = None
+        self.log(' *** initialized Ktamv_Server_Io with camera_url = %s, save_image = %s **** ', camera_url, save_image)
         
 
     def can_read_stream(self, printer):
@@ -32,54 +99,77 @@ class Ktamv_Server_Io:
 
     def open_stream(self):
         self.session = requests.Session()
+        self.reader.start()
 
-    def get_single_frame(self):
+    # captured_after: Only return a frame that arrived after this time.time() value, i.e. after a move
+    # grayscale: Return a single channel frame, decoded without color. color_loader() gives the color frame later.
+    def get_single_frame(self, captured_after = None, grayscale = False):
         self.log(' *** calling get_single_frame **** ')
         
         if self.session is None: 
-            self.log("HTTP stream for reading jpeg is not running")
-            raise Exception("HTTP stream for reading jpeg is not running")
+            self.log("Frame source for reading jpeg is not running", level=logging.WARNING)
+            raise Exception("Frame source for reading jpeg is not running")
 
         try:
-            with self.session.get(self.camera_url, stream=True) as stream:
-                self.log(' stream.ok = %s ' % stream.ok)
-                if stream.ok:
-                    chunk_size = 1024
-                    bytes_ = b''
-                    for chunk in stream.iter_content(chunk_size=chunk_size):
-                        bytes_ += chunk
-                        a = bytes_.find(b'\xff\xd8')
-                        b = bytes_.find(b'\xff\xd9')
-                        if a != -1 and b != -1:
-                            jpg = bytes_[a:b+2]
-                            # Read the image from the byte array with OpenCV
-                            image = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
-                            image = cv2.resize(image, (_FRAME_WIDTH, _FRAME_HEIGHT), interpolation=cv2.INTER_AREA)
-                            # Return the image
-                            return image
-            return None
+            with metrics.timer("ktamv_stage_seconds", span="fetch", stage="fetch"):
+                latest = self.reader.get_latest(self.__last_sequence, captured_after, timeout=_FRAME_TIMEOUT)
+            if latest is None:
+                self.log("No new frame received from camera within %d seconds", _FRAME_TIMEOUT, level=logging.WARNING)
+                return None
+            sequence, self.last_frame_time, jpg = latest
+            metrics.job_count("frames")
+            # Frames that arrived since the last one used were never processed, too old or skipped to get the newest
+            if self.__last_sequence > 0 and sequence - self.__last_sequence > 1:
+                metrics.inc("ktamv_frames_dropped_total", sequence - self.__last_sequence - 1, reason="skipped")
+                metrics.job_count("frames_skipped", sequence - self.__last_sequence - 1)
+            self.__last_sequence = sequence
+            # Read the image from the byte array with OpenCV
+            image = decode_frame(jpg, grayscale)
+            if image is None:
+                metrics.inc("ktamv_frames_dropped_total", reason="decode_error")
+                self.log("Could not decode frame from camera", level=logging.WARNING)
+                return None
+            self.__last_frame = image
+            self.__last_jpeg = jpg
+            # Return the image
+            return image
         except Exception as e:
-            self.log("Failed to get single frame from stream %s" % str(e))
+            self.log("Failed to get single frame from stream %s", e, level=logging.ERROR)
             # raise Exception("Failed to get single frame from stream %s" % str(e))
 
     def close_stream(self):
         if self.session is not None:
             self.session.close()
             self.session = None
-            
+        self.reader.stop()
+        # Frames already queued are still sent
+        if self.__uploader is not None:
+            self.__uploader.close()
+
+    # Returns a function returning the last frame returned in color, decoded only when called.
+    # Used to draw the preview of grayscale frames only when someone looks at it.
+    def color_loader(self):
+        jpg = self.__last_jpeg
+        return lambda: decode_frame(jpg)
+
+    # Queues the frame to be sent to the cloud in the background. It is always sent in color.
+    # The JPEG from the camera is sent as it is if the frame is the last one returned and already was the size used.
     def send_frame_to_cloud(self, frame, points, algorithm):
         try:
             self.log(' *** calling send_frame_to_cloud **** ')
-            _, img_encoded = cv2.imencode('.jpg', frame)
-            data = {'photo': base64.b64encode(img_encoded), 'algorithm': algorithm, 'points': str(points)}
-            
-            response = requests.post(self.cloud_url, data=data)
-            if response.status_code != 200:
-                self.log("Failed to send frame to cloud, got status code %d" % response.status_code)
-                return False
-            self.log(' *** sent frame to cloud **** ')
-            self.log(' *** response = %s **** :' % response.text)
+            last = frame is self.__last_frame and self.__last_jpeg is not None
+            if last and jpeg_size(self.__last_jpeg) == (_FRAME_WIDTH, _FRAME_HEIGHT):
+                jpeg = self.__last_jpeg
+            else:
+                if last and frame.ndim == 2:
+                    frame = decode_frame(self.__last_jpeg)
+                with metrics.timer("ktamv_stage_seconds", span="cloud_encode", stage="cloud_encode"):
+                    _, img_encoded = cv2.imencode('.jpg', frame)
+                jpeg = img_encoded.tobytes()
+            if self.__uploader is None:
+                self.__uploader = Ktamv_Server_Cloud_Uploader(self.log, self.cloud_url)
+            self.__uploader.submit(jpeg, points, algorithm)
             return True
         except Exception as e:
-            self.log("Failed to send frame to cloud %s" % str(e))
+            self.log("Failed to send frame to cloud %s", e, level=logging.WARNING)
             return False    
@@ -0,0 +1,158 @@
+import itertools, logging, threading, time
+from collections import deque
+from ktamv_server_metrics import metrics
+
+
+class Ktamv_Server_Job:
+    # A detection job run for one or more requests looking for the same tool.
+
+    def __init__(self, job_id, tool, captured_after, request_id, deadline):
+        self.job_id = job_id
+        self.tool = tool
+        # Only frames captured after this time.time() are used
+        self.captured_after = captured_after
+        # The requests waiting for this job, request id -> time.time() it was submitted
+        self.requests = {request_id: time.time()}
+        # time.time() after which no request waits for the result anymore
+        self.deadline = deadline
+        self.created = time.time()
+        self.started = None
+        self.cancelled = threading.Event()
+
+    # Returns True if the job should stop looking, because it was cancelled or nobody waits for it anymore
+    def should_stop(self):
+        return self.cancelled.is_set() or time.time() > self.deadline
+
+
+class Ktamv_Server_Job_Queue:
+    # Runs detection jobs one at a time on a single worker thread, so only one job uses the camera.
+    # Requests for the same tool that arrive while a job is waiting are added to that job,
+    # and all get its result. Jobs nobody waits for anymore are dropped or stopped.
+
+    # log: Function to log messages with
+    # run_job: Function running a Ktamv_Server_Job and returning its result
+    # finish_job: Function storing the result for the requests of a job, called with the job, its requests
+    #   as in Ktamv_Server_Job.requests and the result. The result is None and job.started is None if the deadline passed before it started.
+    # max_queued: Maximum amount of jobs waiting
+    def __init__(self, log, run_job, finish_job, max_queued = 16):
+        self.log = log
+        self.run_job = run_job
+        self.finish_job = finish_job
+        self.max_queued = max_queued
+        self.__condition = threading.Condition()
+        self.__queue = deque()
+        self.__running = None
+        self.__thread = None
+        self.__ids = itertools.count(1)
+        # Seconds the last jobs waited before they started
+        self.__waits = deque(maxlen=100)
+        self.__counts = {"submitted": 0, "coalesced": 0, "completed": 0, "cancelled": 0, "expired": 0, "rejected": 0}
+
+    # Adds a request to a job and returns the job, or None if too many jobs are waiting.
+    # captured_after: The request only accepts frames captured after this time.time()
+    # deadline: time.time() after which the request does not wait for the result anymore
+    def submit(self, request_id, tool, captured_after, deadline):
+        with self.__condition:
+            self.__counts["submitted"] += 1
+            # A waiting job has not taken any frames yet, it just needs to wait for the newer frames
+            for job in self.__queue:
+                if job.tool == tool:
+                    job.captured_after = max(job.captured_after, captured_after)
+                    return self.__join(job, request_id, deadline)
+            # The running job only gives the same result if it only uses frames this request accepts
+            job = self.__running
+            if job is not None and job.tool == tool and job.captured_after >= captured_after and not job.should_stop():
+                return self.__join(job, request_id, deadline)
+
+            if len(self.__queue) >= self.max_queued:
+                self.__counts["rejected"] += 1
+                metrics.inc("ktamv_jobs_total", result="rejected")
+                return None
+            job = Ktamv_Server_Job(next(self.__ids), tool, captured_after, request_id, deadline)
+            self.__queue.append(job)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="ktamv-jobs", daemon=True)
+                self.__thread.start()
+            self.__condition.notify_all()
+            return job
+
+    # Removes the request from its job. The job is cancelled when no other request waits for it.
+    # Returns True if the request was waiting for a job.
+    def cancel(self, request_id):
+        with self.__condition:
+            for job in list(self.__queue) + ([self.__running] if self.__running is not None else []):
+                if request_id in job.requests:
+                    del job.requests[request_id]
+                    if not job.requests:
+                        job.cancelled.set()
+                        self.__counts["cancelled"] += 1
+                        metrics.inc("ktamv_jobs_total", result="cancelled")
+                        if job in self.__queue:
+                            self.__queue.remove(job)
+                    return True
+            return False
+
+    # Returns the queue depth, the running job and wait times as a dictionary
+    def stats(self):
+        with self.__condition:
+            now = time.time()
+            waits = list(self.__waits)
+            running = self.__running
+            return {
+                "queued": len(self.__queue),
+                "oldest_queued_wait": round(now - self.__queue[0].created, 3) if self.__queue else 0,
+                "running": None if running is None else {
+                    "job_id": running.job_id,
+                    "tool": running.tool,
+                    "request_ids": list(running.requests),
+                    "runtime": round(now - running.started, 3),
+                },
+                "wait_avg": round(sum(waits) / len(waits), 3) if waits else 0,
+                "wait_max": round(max(waits), 3) if waits else 0,
+                **self.__counts,
+            }
+
+    def __join(self, job, request_id, deadline):
+        job.requests[request_id] = time.time()
+        job.deadline = max(job.deadline, deadline)
+        self.__counts["coalesced"] += 1
+        return job
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__queue:
+                    self.__condition.wait()
+                job = self.__queue.popleft()
+                if job.should_stop():
+                    self.__counts["expired"] += 1
+                    expired = True
+                else:
+                    expired = False
+                    job.started = time.time()
+                    self.__waits.append(job.started - job.created)
+                    metrics.observe("ktamv_job_wait_seconds", job.started - job.created)
+                    self.__running = job
+
+            result = None
+            try:
+                if expired:
+                    self.log("Job %d dropped, deadline passed before it started", job.job_id, level=logging.INFO)
+                else:
+                    result = self.run_job(job)
+            except Exception as e:
+                self.log("Error in job %d: %s", job.job_id, e, level=logging.ERROR)
+            finally:
+                # No request can join the job after this, so every request of it gets the result
+                with self.__condition:
+                    if not expired:
+                        self.__counts["completed"] += 1
+                        metrics.observe("ktamv_job_seconds", time.time() - job.started)
+                    metrics.inc("ktamv_jobs_total", result="expired" if expired else "completed")
+                    self.__running = None
+                    requests = dict(job.requests)
+            if requests:
+                try:
+                    self.finish_job(job, requests, result)
+                except Exception as e:
+                    self.log("Error finishing job %d: %s", job.job_id, e, level=logging.ERROR)
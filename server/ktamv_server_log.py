@@ -0,0 +1,97 @@
+import itertools, logging, threading, time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+
+@dataclass
+class Ktamv_Server_Log_Record:
+    seq: int
+    time: float
+    level: str
+    job_id: int
+    message: str
+
+
+class Ktamv_Server_Log:
+    # Keeps the last max_records log messages in memory, for the log endpoint and the status page.
+    # Messages below the level are dropped before they are formatted, so debug logging
+    # from the detection loops costs almost nothing when it is not wanted.
+    # Every message is also passed on to the Python logger, if given.
+
+    # max_records: Amount of messages kept, the oldest are dropped first
+    # level: Lowest level kept, a logging level or its name
+    # logger: Python logger to also log to
+    def __init__(self, max_records = 2000, level = logging.INFO, logger = None):
+        self.logger = logger
+        self.level = logging.INFO
+        self.set_level(level)
+        self.__records = deque(maxlen=max_records)
+        self.__lock = threading.Lock()
+        self.__seq = itertools.count(1)
+        # Job id of the job running on each thread
+        self.__local = threading.local()
+
+    # Sets the lowest level kept. Raises ValueError if the level is unknown.
+    def set_level(self, level):
+        if isinstance(level, str):
+            name = level.upper()
+            level = logging.getLevelName(name)
+            if not isinstance(level, int):
+                raise ValueError("Unknown log level: " + name)
+        self.level = level
+
+    def enabled(self, level):
+        return level >= self.level
+
+    # Logs the message, formatted with the args like the logging module does only if it is kept
+    def log(self, message, *args, level = logging.DEBUG):
+        if level < self.level:
+            return
+        if args:
+            message = message % args
+        job_id = getattr(self.__local, "job_id", None)
+        with self.__lock:
+            self.__records.append(
+                Ktamv_Server_Log_Record(next(self.__seq), time.time(), logging.getLevelName(level), job_id, message)
+            )
+        if self.logger is not None:
+            self.logger.log(level, message if job_id is None else "[job %d] %s" % (job_id, message))
+
+    # Marks every message logged by this thread while the block runs with the job id
+    @contextmanager
+    def job(self, job_id):
+        previous = getattr(self.__local, "job_id", None)
+        self.__local.job_id = job_id
+        try:
+            yield
+        finally:
+            self.__local.job_id = previous
+
+    # Returns a tuple of (total amount matching, list of records) oldest first.
+    # level: Only records of this level or above
+    # job_id: Only records of this job
+    # after: Only records with a seq above this, to get what was logged since the last call
+    # offset, limit: The page of matching records to return
+    def query(self, level = None, job_id = None, after = None, offset = 0, limit = 100):
+        if isinstance(level, str):
+            level = logging.getLevelName(level.upper())
+            if not isinstance(level, int):
+                raise ValueError("Unknown log level")
+        with self.__lock:
+            records = list(self.__records)
+        matching = [
+            record for record in records
+            if (level is None or logging.getLevelName(record.level) >= level)
+            and (job_id is None or record.job_id == job_id)
+            and (after is None or record.seq > after)
+        ]
+        return len(matching), matching[offset:offset + limit]
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__records)
+
+    def clear(self):
+        with self.__lock:
+            self.__records.clear()
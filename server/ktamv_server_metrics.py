@@ -0,0 +1,207 @@
+import bisect, threading, time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Ktamv_Server_Timeline:
+    # The time spent in each stage and the counts of one detection job, returned with its result.
+    # Spans with the same name are summed, a job processes many frames and each frame passes every stage.
+
+    def __init__(self):
+        self.started = time.time()
+        self.__lock = threading.Lock()
+        # span name -> [count, total seconds, longest seconds, first start in seconds after started]
+        self.__spans = {}
+        # count name -> amount
+        self.__counts = {}
+
+    def add_span(self, name, seconds, started = None):
+        offset = (time.time() - seconds if started is None else started) - self.started
+        with self.__lock:
+            span = self.__spans.get(name)
+            if span is None:
+                self.__spans[name] = [1, seconds, seconds, offset]
+            else:
+                span[0] += 1
+                span[1] += seconds
+                span[2] = max(span[2], seconds)
+
+    def count(self, name, amount = 1):
+        with self.__lock:
+            self.__counts[name] = self.__counts.get(name, 0) + amount
+
+    # Returns the spans and counts as a dictionary, spans in the order they first started
+    def summary(self):
+        with self.__lock:
+            spans = sorted(self.__spans.items(), key=lambda item: item[1][3])
+            return {
+                "spans": {
+                    name: {"count": count, "total": round(total, 4), "max": round(longest, 4), "first": round(first, 4)}
+                    for name, (count, total, longest, first) in spans
+                },
+                **self.__counts,
+            }
+
+
+class Ktamv_Server_Metrics:
+    # Counters, gauges and histograms of what the server does, rendered in the
+    # Prometheus text exposition format by the /metrics endpoint.
+    # Metrics are created the first time they are used, with labels given as keyword arguments.
+    # Values that are only known elsewhere, like queue sizes, are read by collectors when rendering.
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # name -> (type, help)
+        self.__meta = {}
+        # name -> {labels tuple: value}
+        self.__values = {}
+        # name -> {labels tuple: [bucket counts, sum, count]}
+        self.__histograms = {}
+        # Functions returning a list of (name, type, help, labels dict, value) read when rendering
+        self.__collectors = []
+        # The Ktamv_Server_Timeline of the job running on each thread
+        self.__local = threading.local()
+
+    # Describes a metric. Only needed to give it a help text.
+    def describe(self, name, metric_type, help_text):
+        with self.__lock:
+            self.__meta[name] = (metric_type, help_text)
+
+    def inc(self, name, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            self.__meta.setdefault(name, ("counter", ""))
+            values = self.__values.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            self.__meta.setdefault(name, ("gauge", ""))
+            self.__values.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            self.__meta.setdefault(name, ("histogram", ""))
+            histogram = self.__histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = self.__histograms[name][key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            index = bisect.bisect_left(LATENCY_BUCKETS, value)
+            if index < len(LATENCY_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    # Observes the seconds the block takes in the histogram.
+    # span: Name to also add the time under to the timeline of the job running on this thread
+    @contextmanager
+    def timer(self, name, span = None, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.observe(name, seconds, **labels)
+            timeline = getattr(self.__local, "timeline", None)
+            if span is not None and timeline is not None:
+                timeline.add_span(span, seconds)
+
+    # Adds the amount to a count of the timeline of the job running on this thread, if any
+    def job_count(self, name, amount = 1):
+        timeline = getattr(self.__local, "timeline", None)
+        if timeline is not None:
+            timeline.count(name, amount)
+
+    # Returns the timeline of the job running on this thread, or None
+    def current_timeline(self):
+        return getattr(self.__local, "timeline", None)
+
+    # Makes the timeline the one of this thread while the block runs, a new one if None.
+    # Used by jobs, and by threads working for a job with the timeline of the job.
+    @contextmanager
+    def timeline(self, timeline = None):
+        previous = getattr(self.__local, "timeline", None)
+        self.__local.timeline = Ktamv_Server_Timeline() if timeline is None else timeline
+        try:
+            yield self.__local.timeline
+        finally:
+            self.__local.timeline = previous
+
+    # Adds a function returning a list of (name, type, help, labels dict, value), called for every render
+    def add_collector(self, collector):
+        with self.__lock:
+            self.__collectors.append(collector)
+
+    # Returns all metrics in the Prometheus text exposition format
+    def render(self):
+        with self.__lock:
+            meta = dict(self.__meta)
+            values = {name: dict(series) for name, series in self.__values.items()}
+            histograms = {
+                name: {key: (list(h[0]), h[1], h[2]) for key, h in series.items()}
+                for name, series in self.__histograms.items()
+            }
+            collectors = list(self.__collectors)
+
+        for collector in collectors:
+            try:
+                collected = collector()
+            except Exception:
+                continue
+            for name, metric_type, help_text, labels, value in collected:
+                meta.setdefault(name, (metric_type, help_text))
+                values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+        lines = []
+        for name in sorted(set(values) | set(histograms)):
+            metric_type, help_text = meta.get(name, ("untyped", ""))
+            if help_text:
+                lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for key, value in sorted(values.get(name, {}).items()):
+                lines.append("%s%s %s" % (name, _labels(key), _number(value)))
+            for key, (buckets, total, count) in sorted(histograms.get(name, {}).items()):
+                cumulative = 0
+                for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append("%s_bucket%s %d" % (name, _labels(key + (("le", _number(bound)),)), cumulative))
+                lines.append("%s_bucket%s %d" % (name, _labels(key + (("le", "+Inf"),)), count))
+                lines.append("%s_sum%s %s" % (name, _labels(key), _number(total)))
+                lines.append("%s_count%s %d" % (name, _labels(key), count))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in key
+    ) + "}"
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# The metrics of this server, used by every part of it
+metrics = Ktamv_Server_Metrics()
+metrics.describe("ktamv_stage_seconds", "histogram", "Seconds spent in each stage of the frame pipeline")
+metrics.describe("ktamv_combo_seconds", "histogram", "Seconds the blob detector of each detector combo takes on a frame")
+metrics.describe("ktamv_camera_frames_total", "counter", "Frames received from the camera")
+metrics.describe("ktamv_camera_reconnects_total", "counter", "Connections made to the camera stream")
+metrics.describe("ktamv_frames_processed_total", "counter", "Frames run through nozzle detection")
+metrics.describe("ktamv_frames_dropped_total", "counter", "Frames received from the camera but not processed")
+metrics.describe("ktamv_cascade_total", "counter", "Detector combo runs by combo and result")
+metrics.describe("ktamv_job_wait_seconds", "histogram", "Seconds detection jobs waited in the queue before they started")
+metrics.describe("ktamv_job_seconds", "histogram", "Seconds detection jobs ran")
+metrics.describe("ktamv_jobs_total", "counter", "Detection jobs by how they ended")
+metrics.describe("ktamv_cloud_uploads_total", "counter", "Frames sent to the cloud, failed after all attempts or dropped from a full queue")
+metrics.describe("ktamv_cloud_upload_queue", "gauge", "Frames waiting to be sent to the cloud")
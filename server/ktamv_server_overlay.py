@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageFont
+import matplotlib.font_manager as fm
+
+FONT_SIZE = 28
+FONT_COLOR = (255, 255, 255)
+FIRST_ROW_START = (10, 10)
+
+
+class Ktamv_Server_Overlay:
+    # Draws rows of text in black boxes on the preview frame.
+    # The font is looked up and loaded only once. Rows with static text are rendered
+    # once into a layer that is then just pasted onto every frame.
+
+    # font_family: Font to look for with matplotlib, falls back to its default font
+    # max_cached: Maximum amount of rendered rows kept
+    def __init__(self, font_family = "arial", max_cached = 32):
+        self.font_family = font_family
+        self.max_cached = max_cached
+        self.__font = None
+        # (text, row_width) -> rendered RGBA layer
+        self.__layers = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def font(self):
+        if self.__font is None:
+            font_path = fm.findfont(fm.FontProperties(family=self.font_family))
+            self.__font = ImageFont.truetype(font_path, FONT_SIZE)
+        return self.__font
+
+    # Returns the top left corner of the text on the given row.
+    # Rows above zero count from the top of the frame, rows below zero from the bottom.
+    @staticmethod
+    def start_point(row, frame_height):
+        if row > 0:
+            # Row from top
+            return (FIRST_ROW_START[0], FIRST_ROW_START[1] + (row - 1) * (FONT_SIZE + 10) )
+        else:
+            # Row from bottom
+            return (FIRST_ROW_START[0], frame_height - (abs(row) * (FONT_SIZE + 10) + FIRST_ROW_START[1]) )
+
+    # Draws the text on the frame and returns it.
+    # cache: Keep the rendered row for the next frame, only useful for text that does not change every frame
+    def draw_text(self, frame, text, row = 1, row_width = 640, cache = True):
+        start_point = self.start_point(row, frame.height)
+        if not cache:
+            draw = ImageDraw.Draw(frame)
+            draw.rectangle((start_point[0]-5, start_point[1]-5, row_width - start_point[0], start_point[1] + FONT_SIZE + 10), fill=(0,0,0))
+            draw.text(start_point, text, font=self.font(), fill=FONT_COLOR )
+            return frame
+
+        layer = self.__layer(text, row_width)
+        frame.paste(layer, (start_point[0] - 5, start_point[1] - 5), layer)
+        return frame
+
+    # Returns the row rendered as an RGBA layer, from the cache if rendered before
+    def __layer(self, text, row_width):
+        key = (text, row_width)
+        with self.__lock:
+            layer = self.__layers.get(key)
+            if layer is not None:
+                self.__layers.move_to_end(key)
+                return layer
+
+        font = self.font()
+        # The box as drawn on the frame, text longer than the box is drawn outside it on a transparent background
+        box_width = row_width - 2 * FIRST_ROW_START[0] + 6
+        box_height = FONT_SIZE + 16
+        text_width = int(font.getlength(text)) + 10
+        layer = Image.new("RGBA", (max(box_width, text_width), box_height), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        draw.rectangle((0, 0, box_width - 1, box_height - 1), fill=(0, 0, 0, 255))
+        draw.text((5, 5), text, font=font, fill=FONT_COLOR + (255,))
+
+        with self.__lock:
+            self.__layers[key] = layer
+            while len(self.__layers) > self.max_cached:
+                self.__layers.popitem(last=False)
+        return layer
@@ -0,0 +1,76 @@
+import functools, threading, cv2, numpy as np
+from ktamv_server_metrics import metrics
+
+# Gamma used to brighten the frame before preprocessors 0 and 1
+_GAMMA = 1.2
+
+
+# Returns the lookup table mapping the pixel values [0, 255] to their
+# adjusted gamma values. Built only once for every gamma.
+@functools.lru_cache(maxsize=8)
+def gamma_table(gamma = _GAMMA):
+    invGamma = 1.0 / gamma
+    table = np.array([((i / 255.0) ** invGamma) * 255
+        for i in np.arange(0, 256)]).astype( 'uint8' )
+    table.setflags(write=False)
+    return table
+
+
+class Ktamv_Server_Preprocessor:
+    # Preprocesses frames for the blob detectors.
+    # Works on single channel images throughout, the blob detectors convert color images to gray anyway.
+    # Every step writes into an output buffer that is allocated once per frame size and then reused.
+    # An image returned is only valid until the next frame of the same size is preprocessed.
+    def __init__(self, gamma = _GAMMA):
+        self.__table = gamma_table(gamma)
+        # Buffers by (height, width, name)
+        self.__buffers = {}
+        self.__lock = threading.Lock()
+
+    def __buffer(self, frame, name, channels = 1):
+        key = (frame.shape[0], frame.shape[1], channels, name)
+        buffer = self.__buffers.get(key)
+        if buffer is None:
+            with self.__lock:
+                buffer = self.__buffers.get(key)
+                if buffer is None:
+                    shape = (frame.shape[0], frame.shape[1], channels) if channels > 1 else frame.shape[:2]
+                    buffer = np.empty(shape, dtype=np.uint8)
+                    self.__buffers[key] = buffer
+        return buffer
+
+    # Returns the gamma corrected frame, color or grayscale like the frame
+    def gamma(self, frame):
+        with metrics.timer("ktamv_stage_seconds", span="gamma", stage="gamma"):
+            return cv2.LUT(frame, self.__table, dst=self.__buffer(frame, "gamma", 3 if frame.ndim == 3 else 1))
+
+    # Returns the single channel image of the preprocessor for the detectors.
+    # The frame can be color or grayscale, a grayscale frame is used as the luma or gray image directly.
+    # Gamma is then applied to the gray image instead of to every color, so results can differ from a color frame.
+    # gamma_frame: The already gamma corrected frame, needed by preprocessors 0 and 1
+    def preprocess(self, frame, algorithm = 0, gamma_frame = None):
+        with metrics.timer("ktamv_stage_seconds", span="preprocess", stage="preprocess"):
+            return self.__preprocess(frame, algorithm, gamma_frame)
+
+    def __preprocess(self, frame, algorithm, gamma_frame):
+        if algorithm == 0:
+            if gamma_frame is None:
+                gamma_frame = self.gamma(frame)
+            if gamma_frame.ndim == 2:
+                luma = gamma_frame
+            else:
+                # The luma plane of YUV, it is rounded differently than a BGR to gray conversion
+                yuv = cv2.cvtColor(gamma_frame, cv2.COLOR_BGR2YUV, dst=self.__buffer(frame, "yuv", 3))
+                luma = cv2.extractChannel(yuv, 0, dst=self.__buffer(frame, "luma"))
+            blurred = cv2.GaussianBlur(luma, (7,7), 6, dst=self.__buffer(frame, "blur0"))
+            return cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 35, 1, dst=self.__buffer(frame, "out0"))
+        elif algorithm == 1:
+            if gamma_frame is None:
+                gamma_frame = self.gamma(frame)
+            gray = gamma_frame if gamma_frame.ndim == 2 else cv2.cvtColor(gamma_frame, cv2.COLOR_BGR2GRAY, dst=self.__buffer(frame, "gray1"))
+            _, thresholded = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY|cv2.THRESH_TRIANGLE, dst=self.__buffer(frame, "threshold1"))
+            return cv2.GaussianBlur(thresholded, (7,7), 6, dst=self.__buffer(frame, "out1"))
+        elif algorithm == 2:
+            gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.__buffer(frame, "gray2"))
+            return cv2.medianBlur(gray, 5, dst=self.__buffer(frame, "out2"))
+        raise ValueError("Unknown preprocessing algorithm %s" % str(algorithm))
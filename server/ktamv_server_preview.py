@@ -0,0 +1,163 @@
+import io, threading, time
+from dataclasses import dataclass
+from PIL import Image, features
+from ktamv_server_metrics import metrics
+
+
+@dataclass(frozen=True)
+class Ktamv_Server_Preview_Format:
+    # How a viewer wants the preview frame encoded.
+    # width: Width to scale the frame down to keeping its aspect ratio, full size if None
+    # quality: Encoder quality from 1 to 95, the encoder default if None
+    # image_format: "jpeg" or "webp"
+    width: int = None
+    quality: int = None
+    image_format: str = "jpeg"
+
+    FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+    @property
+    def mimetype(self):
+        return self.FORMATS[self.image_format][1]
+
+    # Short text identifying the format, part of the ETag
+    @property
+    def tag(self):
+        return "%s-%s-%s" % (self.image_format, self.width or "full", self.quality or "default")
+
+    # Returns the frame encoded in this format
+    def encode(self, image):
+        with metrics.timer("ktamv_stage_seconds", stage="encode"):
+            return self.__encode(image)
+
+    def __encode(self, image):
+        if self.width is not None and self.width < image.width:
+            height = max(round(image.height * self.width / image.width), 1)
+            image = image.resize((self.width, height), Image.BILINEAR)
+        img_io = io.BytesIO()
+        if self.quality is None:
+            image.save(img_io, self.FORMATS[self.image_format][0])
+        else:
+            image.save(img_io, self.FORMATS[self.image_format][0], quality=self.quality)
+        return img_io.getvalue()
+
+    # Returns True if PIL can encode the format
+    @classmethod
+    def supported(cls, image_format):
+        if image_format == "webp":
+            return features.check("webp")
+        return image_format in cls.FORMATS
+
+
+class Ktamv_Server_Frame_Broadcaster:
+    # Hands out the processed preview frame to every viewer.
+    # Each new frame gets a version number and is rendered at most once,
+    # by the first viewer asking for it, then shared by all viewers.
+    # Every size, quality and format viewers ask for is encoded at most once per version.
+    # Viewers always get the newest version, so a slow viewer skips frames
+    # instead of holding up detection or the other viewers.
+
+    # render: Function returning the current frame as a PIL Image
+    # max_formats: Maximum amount of encoded formats kept for one version
+    def __init__(self, render, max_formats = 8):
+        self.render = render
+        self.max_formats = max_formats
+        self.__condition = threading.Condition()
+        # Held while rendering and encoding, so a version is only rendered and encoded once
+        self.__render_lock = threading.Lock()
+        # Version of the current frame and of the last rendered image
+        self.__version = 1
+        self.__rendered_version = 0
+        self.__image = None
+        # Ktamv_Server_Preview_Format -> encoded bytes of the rendered version
+        self.__encoded = {}
+        # When a viewer last asked for a frame and how many streams are open
+        self.__last_viewed = 0.0
+        self.__streams = 0
+
+    # Marks the frame as changed, the next viewer renders it again. Returns the new version.
+    def invalidate(self):
+        with self.__condition:
+            self.__version += 1
+            self.__condition.notify_all()
+            return self.__version
+
+    def version(self):
+        with self.__condition:
+            return self.__version
+
+    # Records that a viewer looked at the frame without getting it, i.e. it already had the current one
+    def viewed(self):
+        with self.__condition:
+            self.__last_viewed = time.time()
+
+    # Returns True if a stream is open or a viewer asked for a frame in the last within seconds
+    def has_viewers(self, within = 10):
+        with self.__condition:
+            return self.__streams > 0 or time.time() - self.__last_viewed < within
+
+    # Returns a tuple of (version, encoded bytes) of the current frame.
+    # Waits up to timeout seconds for a version newer than after_version,
+    # and returns the current one if none arrived in time.
+    # preview_format: Ktamv_Server_Preview_Format to encode in, full size JPEG if None
+    def get(self, after_version = 0, timeout = 0, preview_format = None):
+        if preview_format is None:
+            preview_format = Ktamv_Server_Preview_Format()
+        deadline = time.time() + timeout
+        with self.__condition:
+            self.__last_viewed = time.time()
+            while self.__version <= after_version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.__condition.wait(remaining)
+            version = self.__version
+            if self.__rendered_version >= version and preview_format in self.__encoded:
+                return self.__rendered_version, self.__encoded[preview_format]
+
+        with self.__render_lock:
+            # Another viewer may have rendered it while waiting for the lock
+            with self.__condition:
+                rendered_version, image = self.__rendered_version, self.__image
+                encoded = self.__encoded.get(preview_format) if rendered_version >= version else None
+            if encoded is not None:
+                return rendered_version, encoded
+            if rendered_version < version:
+                rendered_version, image = version, self.render()
+            encoded = preview_format.encode(image)
+            with self.__condition:
+                if rendered_version > self.__rendered_version:
+                    self.__rendered_version = rendered_version
+                    self.__image = image
+                    self.__encoded = {}
+                if rendered_version == self.__rendered_version and len(self.__encoded) < self.max_formats:
+                    self.__encoded[preview_format] = encoded
+            return rendered_version, encoded
+
+    # Returns a generator of multipart/x-mixed-replace parts for one viewer.
+    # Every new version is sent once. The current frame is sent again after
+    # keepalive seconds without a new one, so closed connections are noticed.
+    def stream(self, boundary, keepalive = 10, preview_format = None):
+        if preview_format is None:
+            preview_format = Ktamv_Server_Preview_Format()
+        content_type = ("Content-Type: " + preview_format.mimetype + "\r\n").encode()
+
+        def generate():
+            with self.__condition:
+                self.__streams += 1
+            try:
+                last_version = 0
+                while True:
+                    version, data = self.get(last_version, keepalive, preview_format)
+                    last_version = version
+                    yield (
+                        b"--" + boundary.encode() + b"\r\n"
+                        + content_type
+                        + b"Content-Length: " + str(len(data)).encode() + b"\r\n\r\n"
+                        + data + b"\r\n"
+                    )
+            finally:
+                with self.__condition:
+                    self.__streams -= 1
+
+        return generate()
@@ -0,0 +1,88 @@
+import itertools, threading, time
+from collections import OrderedDict
+
+
+class Ktamv_Server_Result_Store:
+    # Keeps the results of requests under monotonically increasing ids.
+    # Results are kept in the order they were created, so the oldest are dropped first
+    # when they are older than ttl seconds or when more than max_size are kept.
+    # Looking up a result by id is O(1).
+
+    # ttl: Seconds a result is kept after it was created
+    # max_size: Maximum amount of results kept
+    # on_put: Function called with every result added or replaced
+    def __init__(self, ttl = 3600, max_size = 500, on_put = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.on_put = on_put
+        # request_id -> [created time, result]
+        self.__results = OrderedDict()
+        self.__ids = itertools.count(1)
+        # Notified every time a result is added or replaced
+        self.__lock = threading.Condition(threading.RLock())
+
+    # Returns a new request id, never used before by this store
+    def new_id(self):
+        with self.__lock:
+            return next(self.__ids)
+
+    # Adds a result or replaces the result of an existing id, keeping its creation time
+    def put(self, request_id, result):
+        with self.__lock:
+            now = time.time()
+            entry = self.__results.get(request_id)
+            if entry is None:
+                self.__results[request_id] = [now, result]
+            else:
+                entry[1] = result
+            self.__evict(now)
+            self.__lock.notify_all()
+        if self.on_put is not None:
+            self.on_put(result)
+
+    # Returns the result of the id, or None if not found or already dropped
+    def get(self, request_id):
+        with self.__lock:
+            self.__evict(time.time())
+            entry = self.__results.get(request_id)
+            return None if entry is None else entry[1]
+
+    # Waits up to timeout seconds for the result of the id to have a statuscode other than pending_status.
+    # Returns the result at that time, or None if not found.
+    def wait(self, request_id, timeout, pending_status = 202):
+        deadline = time.time() + timeout
+        with self.__lock:
+            while True:
+                result = self.get(request_id)
+                remaining = deadline - time.time()
+                if result is None or result.statuscode != pending_status or remaining <= 0:
+                    return result
+                self.__lock.wait(remaining)
+
+    # Returns a tuple of (total amount matching, list of results) in creation order.
+    # status: Only results with this statuscode
+    # since, until: Only results created in this time.time() range
+    # offset, limit: The page of matching results to return
+    def query(self, status = None, since = None, until = None, offset = 0, limit = 100):
+        with self.__lock:
+            self.__evict(time.time())
+            matching = [
+                result
+                for created, result in self.__results.values()
+                if (status is None or result.statuscode == status)
+                and (since is None or created >= since)
+                and (until is None or created <= until)
+            ]
+        return len(matching), matching[offset:offset + limit]
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__results)
+
+    def __evict(self, now):
+        while self.__results:
+            request_id, (created, _) = next(iter(self.__results.items()))
+            if len(self.__results) > self.max_size or now - created > self.ttl:
+                del self.__results[request_id]
+            else:
+                break
@@ -0,0 +1,113 @@
+import logging, threading, time
+from contextlib import contextmanager
+
+
+class Ktamv_Server_Preview_Scheduler:
+    # Runs the preview on one worker thread at a limited frame rate.
+    # The time between frames grows with what a frame costs, so the preview never
+    # uses more than max_cpu_share of a core, and drops to idle_fps when nobody is watching.
+    # Detection jobs pause it while they use the camera, it continues when they are done.
+
+    # log: Function to log messages with
+    # run_frame: Function getting, detecting and publishing one preview frame
+    # has_viewers: Function returning True if someone is watching the preview
+    # max_fps: Highest frame rate while someone is watching
+    # idle_fps: Frame rate while nobody is watching
+    # max_cpu_share: Largest part of the time spent on preview frames, from 0 to 1
+    def __init__(self, log, run_frame, has_viewers, max_fps = 2, idle_fps = 0.2, max_cpu_share = 0.5):
+        self.log = log
+        self.run_frame = run_frame
+        self.has_viewers = has_viewers
+        self.max_fps = max_fps
+        self.idle_fps = idle_fps
+        self.max_cpu_share = max_cpu_share
+        self.__condition = threading.Condition()
+        self.__thread = None
+        self.__running = False
+        # Amount of detection jobs pausing the preview
+        self.__pauses = 0
+        # Moving average of the seconds one frame takes, and the interval used for the last frame
+        self.__frame_cost = 0.0
+        self.__interval = 0.0
+        self.__frames = 0
+
+    # Starts the worker if not already running. Returns False if it was already running.
+    def start(self):
+        with self.__condition:
+            if self.__running:
+                return False
+            self.__running = True
+            # The previous worker may still be finishing its frame, it stops when it sees it was replaced
+            self.__thread = threading.Thread(target=self.__run, name="ktamv-preview", daemon=True)
+            self.__thread.start()
+            return True
+
+    def stop(self):
+        with self.__condition:
+            self.__running = False
+            self.__thread = None
+            self.__condition.notify_all()
+
+    def is_running(self):
+        with self.__condition:
+            return self.__running
+
+    # Pauses the preview while the block runs, for detection jobs using the camera.
+    # Only keeps new preview frames from starting, a frame already being processed is
+    # not waited for here. The detection manager's lock keeps it apart from the job.
+    @contextmanager
+    def paused(self):
+        with self.__condition:
+            self.__pauses += 1
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__pauses -= 1
+                self.__condition.notify_all()
+
+    # Returns the state of the preview as a dictionary
+    def stats(self):
+        with self.__condition:
+            return {
+                "running": self.__running,
+                "paused": self.__pauses > 0,
+                "frames": self.__frames,
+                "frame_cost": round(self.__frame_cost, 4),
+                "fps": round(1 / self.__interval, 2) if self.__interval > 0 else 0,
+            }
+
+    # Returns the seconds from the start of one frame to the start of the next
+    def __next_interval(self):
+        fps = self.max_fps if self.has_viewers() else self.idle_fps
+        return max(1 / fps, self.__frame_cost / self.max_cpu_share)
+
+    def __run(self):
+        self.log("*** calling do_preview ***")
+        me = threading.current_thread()
+        while True:
+            with self.__condition:
+                while self.__running and self.__thread is me and self.__pauses > 0:
+                    self.__condition.wait()
+                if not self.__running or self.__thread is not me:
+                    break
+
+            started = time.perf_counter()
+            try:
+                self.run_frame()
+            except Exception as e:
+                self.log("Error in preview: %s", e, level=logging.ERROR)
+            cost = time.perf_counter() - started
+
+            with self.__condition:
+                self.__frames += 1
+                self.__frame_cost = cost if self.__frames == 1 else 0.8 * self.__frame_cost + 0.2 * cost
+                # Sleep the rest of the interval, waking up early if stopped.
+                # The interval is checked again while sleeping so a new viewer does not wait for the idle interval.
+                while self.__running and self.__thread is me:
+                    self.__interval = self.__next_interval()
+                    remaining = started + self.__interval - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.__condition.wait(min(remaining, 1 / self.max_fps))
+        self.log("*** end of do_preview ***")
@@ -0,0 +1,201 @@
+import logging, os, time
+from urllib.parse import urlsplit, parse_qs, unquote
+import requests
+from ktamv_server_metrics import metrics
+from ktamv_server_stream import Ktamv_Server_Frame_Source, Ktamv_Server_Mjpeg_Reader, iter_jpegs
+
+# Frames per second recordings are replayed at if no fps is given
+_REPLAY_FPS = 15
+# File extensions read from a directory of frames
+_JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+
+class Ktamv_Server_Snapshot_Reader(Ktamv_Server_Frame_Source):
+    # Asks a snapshot URL for JPEGs over a single keep-alive connection,
+    # instead of opening a new connection for every image.
+    # A snapshot is only asked for when a reader wants a newer frame than the last one,
+    # so the camera is not polled while nothing needs a frame.
+    # Every frame is stamped with the time it was asked for, the camera took it after that.
+
+    kind = "snapshot reader"
+
+    # camera_url: URL returning one JPEG
+    # min_interval: Ask for snapshots at most this often, in seconds, also when the camera sends the same one again
+    def __init__(self, log, camera_url, min_interval = 0.05, reconnect_delay = 0.5, idle_timeout = 30):
+        super().__init__(log, camera_url, reconnect_delay, idle_timeout)
+        self.min_interval = min_interval
+        self.__session = None
+
+    def _interrupt(self):
+        session = self.__session
+        self.__session = None
+        if session is not None:
+            session.close()
+
+    def _read(self):
+        if self.__session is None:
+            self.__session = requests.Session()
+            metrics.inc("ktamv_camera_reconnects_total")
+        session = self.__session
+        while self._wait_wanted():
+            requested_at = time.time()
+            response = session.get(self.camera_url, timeout=(5, 10))
+            if not response.ok:
+                self.log("Snapshot reader got status code %d from %s", response.status_code, self.camera_url, level=logging.WARNING)
+                return False
+            if not response.content.startswith(b'\xff\xd8'):
+                self.log("Snapshot reader got no JPEG from %s, is it a stream?", self.camera_url, level=logging.WARNING)
+                return False
+            self._publish(response.content, requested_at)
+            if not self._wait(self.min_interval - (time.time() - requested_at)):
+                break
+        return True
+
+
+class Ktamv_Server_Replay_Source(Ktamv_Server_Frame_Source):
+    # Replays recorded frames, for benchmarks and for testing against captures from a real printer
+    # without a camera. Subclasses implement _frames(), returning the JPEGs of one pass over the recording.
+    # Frames are stamped with the time they are published, so they look like they were just captured.
+    # At the native rate frames are published at fps frames per second, like a camera would.
+    # At the maximum rate the next frame is published as soon as a reader asks for a newer one,
+    # so every frame is used exactly once, as fast as the frames can be processed.
+
+    kind = "replay"
+
+    # path: File or directory to read the recording from
+    # fps: Frames per second to replay at, None to replay at the maximum rate
+    # loop: Start over at the end of the recording, or stop
+    def __init__(self, log, camera_url, path, fps = _REPLAY_FPS, loop = True, idle_timeout = 30):
+        super().__init__(log, camera_url, idle_timeout = idle_timeout)
+        self.path = path
+        self.fps = fps
+        self.loop = loop
+        # When to publish the next frame at the native rate, kept from one pass to the next
+        self.__next_time = 0.0
+
+    def _frames(self):
+        raise NotImplementedError()
+
+    def _read(self):
+        published = 0
+        for jpeg in self._frames():
+            if self.fps is None:
+                if not self._wait_wanted():
+                    return True
+            else:
+                if not self._wait(self.__next_time - time.time()):
+                    return True
+                # Do not try to catch up when falling behind, like a camera would not
+                self.__next_time = max(self.__next_time + 1.0 / self.fps, time.time())
+            self._publish(jpeg, time.time())
+            published += 1
+        if published == 0:
+            self.log("%s found no frames in %s", self.kind, self.path, level=logging.WARNING)
+            return False
+        if not self.loop:
+            self._finish()
+        # The first frames are published again on the next pass
+        self._forget_frames()
+        return True
+
+
+class Ktamv_Server_Recording_Source(Ktamv_Server_Replay_Source):
+    # Replays an MJPEG stream recorded to a file, e.g. with curl from the camera stream URL.
+    # A file with a single JPEG works too.
+
+    kind = "recording"
+
+    def __init__(self, log, camera_url, path, fps = _REPLAY_FPS, loop = True, chunk_size = 65536, max_buffer = 8 * 1024 * 1024, idle_timeout = 30):
+        super().__init__(log, camera_url, path, fps, loop, idle_timeout)
+        self.chunk_size = chunk_size
+        self.max_buffer = max_buffer
+        self.__buffer = bytearray()
+
+    def _frames(self):
+        with open(self.path, "rb") as f:
+            yield from iter_jpegs(iter(lambda: f.read(self.chunk_size), b""), self.__buffer, self.max_buffer, self.log)
+
+
+class Ktamv_Server_Directory_Source(Ktamv_Server_Replay_Source):
+    # Replays the JPEG files in a directory, in the order of their names.
+    # The directory is listed again on every pass, so frames can be added while it runs.
+
+    kind = "directory"
+
+    def _frames(self):
+        names = sorted(name for name in os.listdir(self.path) if name.lower().endswith(_JPEG_EXTENSIONS))
+        for name in names:
+            try:
+                with open(os.path.join(self.path, name), "rb") as f:
+                    jpeg = f.read()
+            except OSError as e:
+                self.log("Could not read frame %s: %s", name, e, level=logging.WARNING)
+                continue
+            yield jpeg
+
+
+# Returns a tuple of (kind, options) describing the frame source for the URL.
+# Raises ValueError with the reason if no frame source can read from it.
+#   http(s)://host/stream                 A camera stream
+#   http(s)://host/snapshot               A snapshot URL, if the path or an action parameter is "snapshot" or it ends with .jpg
+#   file:///path/to/recording.mjpeg       A recorded stream or a single JPEG
+#   file:///path/to/directory             The JPEG files in a directory
+# Files take the parameters fps to replay at, rate=max to replay as fast as frames are processed and loop=0 to stop at the end.
+def parse_frame_source_url(camera_url):
+    url = urlsplit(camera_url)
+    scheme = url.scheme.casefold()
+    query = parse_qs(url.query)
+    if scheme in ("http", "https"):
+        if not url.netloc:
+            raise ValueError("Camera path has no host")
+        last = url.path.rstrip("/").rsplit("/", 1)[-1].casefold()
+        if (
+            last.startswith("snapshot")
+            or last.endswith(_JPEG_EXTENSIONS)
+            or "snapshot" in [action.casefold() for action in query.get("action", [])]
+        ):
+            return "snapshot", {}
+        return "stream", {}
+    if scheme == "file":
+        if url.netloc not in ("", "localhost"):
+            raise ValueError("Camera path must be a local file, file:///path")
+        path = unquote(url.path)
+        if os.path.isdir(path):
+            kind = "directory"
+        elif os.path.isfile(path):
+            kind = "recording"
+        else:
+            raise ValueError("Camera path %s does not exist" % path)
+        options = {"path": path}
+        rate = query.get("rate", [""])[-1].casefold()
+        fps = query.get("fps", [None])[-1]
+        if rate == "max":
+            options["fps"] = None
+        elif rate not in ("", "native"):
+            raise ValueError("Camera path rate must be native or max")
+        elif fps is not None:
+            try:
+                options["fps"] = float(fps)
+            except ValueError:
+                raise ValueError("Camera path fps must be a number")
+            if options["fps"] <= 0:
+                raise ValueError("Camera path fps must be above 0")
+        loop = query.get("loop", [None])[-1]
+        if loop is not None:
+            options["loop"] = loop.casefold() not in ("0", "false", "no")
+        return kind, options
+    raise ValueError("Camera path must start with http://, https:// or file://")
+
+
+# Returns a frame source reading from the URL, see parse_frame_source_url
+# idle_timeout: Stop reading if no frame has been asked for in this many seconds, None to read until stopped
+def create_frame_source(log, camera_url, idle_timeout = 30):
+    kind, options = parse_frame_source_url(camera_url)
+    options["idle_timeout"] = idle_timeout
+    if kind == "snapshot":
+        return Ktamv_Server_Snapshot_Reader(log, camera_url, **options)
+    if kind == "recording":
+        return Ktamv_Server_Recording_Source(log, camera_url, **options)
+    if kind == "directory":
+        return Ktamv_Server_Directory_Source(log, camera_url, **options)
+    return Ktamv_Server_Mjpeg_Reader(log, camera_url, **options)
@@ -0,0 +1,269 @@
+import logging, threading, time, zlib
+from collections import deque
+import requests
+from ktamv_server_metrics import metrics
+
+# Start and end markers of a JPEG image in the stream
+_JPEG_SOI = b'\xff\xd8'
+_JPEG_EOI = b'\xff\xd9'
+# Amount of recent frames a new frame is compared with to find repeats
+_RECENT_FINGERPRINTS = 4
+
+
+# Returns a fingerprint of the JPEG bytes, equal for byte identical frames
+def jpeg_fingerprint(jpeg):
+    return len(jpeg), zlib.crc32(jpeg)
+
+
+# Splits a byte stream into the complete JPEGs in it, as sent by MJPEG cameras or recorded from them.
+# Everything between the end of one JPEG and the start of the next, like multipart headers, is skipped.
+# chunks: Iterable of bytes read from the stream
+# buffer: bytearray to parse in, can be reused between calls
+# max_buffer: Discard the buffer if it grows beyond this many bytes without a complete JPEG
+def iter_jpegs(chunks, buffer, max_buffer, log):
+    del buffer[:]
+    soi = -1
+    for chunk in chunks:
+        # Only scan the new bytes, and the last old byte in case a marker was split
+        scan_from = max(len(buffer) - 1, 0)
+        buffer += chunk
+        while True:
+            if soi < 0:
+                soi = buffer.find(_JPEG_SOI, scan_from)
+                if soi < 0:
+                    # No frame started, keep only the last byte
+                    del buffer[:-1]
+                    break
+                scan_from = soi + 2
+            eoi = buffer.find(_JPEG_EOI, max(scan_from, soi + 2))
+            if eoi < 0:
+                if len(buffer) > max_buffer:
+                    log("Discarded %d bytes without a complete frame", len(buffer), level=logging.WARNING)
+                    del buffer[:]
+                    soi = -1
+                break
+            yield bytes(buffer[soi:eoi + 2])
+            del buffer[:eoi + 2]
+            soi = -1
+            scan_from = 0
+
+
+class Ktamv_Server_Frame_Source:
+    # Reads frames in a background thread and publishes only the newest JPEG into a single slot.
+    # Subclasses implement _read(), which reads frames and hands them to _publish() until
+    # it fails or the source is stopped. It is called again for as long as the source runs.
+    # Repeats of one of the last frames are dropped before they are published,
+    # so every frame handed out is a new capture.
+    # A source that runs out of frames calls _finish(), it then stays stopped until stop() is called.
+    # Readers then get no new frame, like from a camera that stopped sending.
+
+    # Name used in the log and for the thread
+    kind = "frame source"
+
+    # camera_url: URL the frames are read from
+    # reconnect_delay: Seconds to wait before calling _read() again after it failed
+    # idle_timeout: Stop reading if no frame has been asked for in this many seconds, None to read until stopped
+    def __init__(self, log, camera_url, reconnect_delay = 0.5, idle_timeout = 30):
+        self.log = log
+        self.camera_url = camera_url
+        self.reconnect_delay = reconnect_delay
+        self.idle_timeout = idle_timeout
+
+        # Guards the slot and the running state, notified when a new frame arrives or one is asked for
+        self.__condition = threading.Condition()
+        # The slot holding the newest JPEG, its sequence number and time stamp
+        self.__jpeg = None
+        self.__sequence = 0
+        self.__timestamp = 0.0
+        # Sequence number of the newest frame a reader asked to get past
+        self.__wanted = 0
+        # Fingerprints of the last frames published
+        self.__fingerprints = deque(maxlen=_RECENT_FINGERPRINTS)
+        self.__running = False
+        self.__finished = False
+        self.__thread = None
+        self.__last_request = time.time()
+
+    def start(self):
+        with self.__condition:
+            self.__last_request = time.time()
+            if self.__running or self.__finished:
+                return
+            self.__running = True
+            self.__thread = threading.Thread(target=self.__run, name="ktamv-" + self.kind.replace(" ", "-").lower(), daemon=True)
+            self.__thread.start()
+        self.log(' *** started %s for %s **** ', self.kind, self.camera_url, level=logging.INFO)
+
+    def stop(self):
+        with self.__condition:
+            self.__finished = False
+            if not self.__running:
+                return
+            self.__running = False
+            thread = self.__thread
+            self.__condition.notify_all()
+        self._interrupt()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=2)
+        self.log(' *** stopped %s for %s **** ', self.kind, self.camera_url, level=logging.INFO)
+
+    def is_running(self):
+        return self.__running
+
+    # Returns a tuple of (sequence, timestamp, jpeg bytes) with the newest frame, timestamp is 0 if not known.
+    # Waits up to timeout seconds for a frame with a sequence number higher than after_sequence
+    # and, if captured_after is given, a time stamp later than captured_after.
+    # Returns None if no such frame arrived in time.
+    def get_latest(self, after_sequence = 0, captured_after = None, timeout = 5.0):
+        self.start()
+        deadline = time.time() + timeout
+        with self.__condition:
+            while self.__sequence <= after_sequence or (captured_after is not None and self.__timestamp <= captured_after):
+                remaining = deadline - time.time()
+                # A source that ran out of frames is waited on like a camera that stopped sending
+                if remaining <= 0 or not (self.__running or self.__finished):
+                    return None
+                if self.__wanted < self.__sequence:
+                    self.__wanted = self.__sequence
+                    self.__condition.notify_all()
+                self.__condition.wait(remaining)
+                self.__last_request = time.time()
+            return self.__sequence, self.__timestamp, self.__jpeg
+
+    # Reads frames until it fails or the source is stopped.
+    # Returns False if it failed, to be called again after reconnect_delay.
+    def _read(self):
+        raise NotImplementedError()
+
+    # Called when the source is stopped, to break a blocking read in _read()
+    def _interrupt(self):
+        pass
+
+    # Publishes the JPEG as the newest frame, unless it is a repeat of one of the last ones
+    def _publish(self, jpeg, timestamp):
+        metrics.inc("ktamv_camera_frames_total")
+        fingerprint = jpeg_fingerprint(jpeg)
+        if fingerprint in self.__fingerprints:
+            # A repeat is not a new capture, it must not wake up waiting detections or count as a match
+            metrics.inc("ktamv_frames_dropped_total", reason="duplicate")
+            return
+        self.__fingerprints.append(fingerprint)
+        with self.__condition:
+            self.__jpeg = jpeg
+            self.__sequence += 1
+            self.__timestamp = timestamp
+            self.__condition.notify_all()
+
+    # Forgets the frames published, so the next ones are published even if they are repeats.
+    # Used when a recording starts over.
+    def _forget_frames(self):
+        self.__fingerprints.clear()
+
+    # Returns True while the source should keep going, stops it when idle for too long
+    def _keep_running(self):
+        with self.__condition:
+            if self.__running and self.idle_timeout is not None and time.time() - self.__last_request > self.idle_timeout:
+                self.__running = False
+                self.log(' *** %s idle for %.0f seconds, closing **** ', self.kind, self.idle_timeout, level=logging.INFO)
+            return self.__running
+
+    # Waits the given seconds or until stopped. Returns True if still running.
+    def _wait(self, seconds):
+        deadline = time.time() + seconds
+        with self.__condition:
+            while self._keep_running():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return True
+                self.__condition.wait(remaining)
+            return False
+
+    # Waits until a reader asks for a frame newer than the one published, or until stopped.
+    # Returns True if still running.
+    def _wait_wanted(self):
+        with self.__condition:
+            while self._keep_running():
+                if self.__wanted >= self.__sequence:
+                    return True
+                self.__condition.wait(1)
+            return False
+
+    # Stops the source because it ran out of frames
+    def _finish(self):
+        with self.__condition:
+            self.__running = False
+            self.__finished = True
+            self.__condition.notify_all()
+        self.log(' *** %s ran out of frames from %s **** ', self.kind, self.camera_url, level=logging.INFO)
+
+    def __run(self):
+        while self._keep_running():
+            try:
+                if self._read():
+                    continue
+            except Exception as e:
+                if not self.__running:
+                    continue
+                self.log("%s failed to read from %s: %s", self.kind, self.camera_url, e, level=logging.WARNING)
+            self._wait(self.reconnect_delay)
+
+
+class Ktamv_Server_Mjpeg_Reader(Ktamv_Server_Frame_Source):
+    # Keeps one HTTP connection to the camera stream open and publishes every frame it sends.
+    # Snapshot URLs work too, the connection is reopened when a newer image is asked for.
+    # A stream that ends, or a response without a JPEG, is retried after reconnect_delay.
+    # Every frame is stamped with the time it arrived. The first frame of a stream may be a
+    # cached one taken before the connection was opened, so it is stamped 0 and is never new
+    # enough for captured_after. A snapshot is stamped with the time it was asked for.
+    # Cameras often send the same cached JPEG several times, such repeats are dropped.
+
+    kind = "MJPEG reader"
+
+    # camera_url: URL of the camera stream or snapshot
+    # chunk_size: Amount of bytes to read from the connection at a time
+    # max_buffer: Discard the buffer if it grows beyond this many bytes without a complete JPEG
+    def __init__(self, log, camera_url, chunk_size = 16384, max_buffer = 8 * 1024 * 1024, reconnect_delay = 0.5, idle_timeout = 30):
+        super().__init__(log, camera_url, reconnect_delay, idle_timeout)
+        self.chunk_size = chunk_size
+        self.max_buffer = max_buffer
+        self.__session = None
+        # The parse buffer is reused for the whole lifetime of the reader
+        self.__buffer = bytearray()
+
+    def _interrupt(self):
+        # Closing the session breaks a blocking read in the reader thread
+        session = self.__session
+        if session is not None:
+            session.close()
+
+    def _read(self):
+        session = requests.Session()
+        self.__session = session
+        connected_at = time.time()
+        metrics.inc("ktamv_camera_reconnects_total")
+        try:
+            with session.get(self.camera_url, stream=True, timeout=(5, 10)) as stream:
+                if not stream.ok:
+                    self.log("MJPEG reader got status code %d from %s", stream.status_code, self.camera_url, level=logging.WARNING)
+                    return False
+                multipart = stream.headers.get("Content-Type", "").casefold().startswith("multipart/")
+                published = 0
+                first_timestamp = 0.0 if multipart else connected_at
+                for jpeg in iter_jpegs(stream.iter_content(chunk_size=self.chunk_size), self.__buffer, self.max_buffer, self.log):
+                    self._publish(jpeg, first_timestamp if published == 0 else time.time())
+                    published += 1
+                    if not self._keep_running():
+                        return True
+        finally:
+            self.__session = None
+            session.close()
+
+        if published == 0:
+            self.log("MJPEG reader got no frame from %s", self.camera_url, level=logging.WARNING)
+            return False
+        if not multipart:
+            # A snapshot, the next one is only fetched when a reader asks for a newer frame
+            self._wait_wanted()
+            return True
+        self.log("MJPEG stream from %s ended", self.camera_url, level=logging.INFO)
+        return False
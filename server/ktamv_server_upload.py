@@ -0,0 +1,111 @@
+import base64, logging, threading, time
+from collections import deque
+import requests
+from ktamv_server_metrics import metrics
+
+
+class Ktamv_Server_Cloud_Uploader:
+    # Sends frames with detected nozzles to the cloud in the background, so detection never waits for it.
+    # Frames are queued and sent one after another over one kept-alive connection.
+    # A failed upload is retried with exponential backoff. When the queue is full the
+    # oldest frame is dropped, the newest frames are the most useful.
+
+    # log: Function to log messages with
+    # cloud_url: URL to post the frames to
+    # max_queue: Maximum amount of frames waiting to be sent
+    # max_attempts: Times to try sending a frame before dropping it
+    # backoff: Seconds to wait after the first failure, doubled after every following failure up to max_backoff
+    # timeout: Seconds to wait for the cloud to answer
+    def __init__(self, log, cloud_url, max_queue = 20, max_attempts = 4, backoff = 2.0, max_backoff = 60.0, timeout = 10):
+        self.log = log
+        self.cloud_url = cloud_url
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.__condition = threading.Condition()
+        # [jpeg bytes, points, algorithm, attempts]
+        self.__queue = deque()
+        self.__thread = None
+        self.__closed = False
+        self.__counts = {"queued": 0, "sent": 0, "failed": 0, "dropped": 0}
+
+    # Queues the JPEG encoded frame for sending. Never blocks.
+    def submit(self, jpeg, points, algorithm):
+        with self.__condition:
+            if self.__closed:
+                return
+            if len(self.__queue) >= self.max_queue:
+                self.__queue.popleft()
+                self.__count("dropped", "queue_full")
+            self.__queue.append([jpeg, points, algorithm, 0])
+            self.__counts["queued"] += 1
+            metrics.set("ktamv_cloud_upload_queue", len(self.__queue))
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="ktamv-cloud", daemon=True)
+                self.__thread.start()
+            self.__condition.notify_all()
+
+    # Stops the uploader after the frames already queued are sent, or tried once if the cloud fails
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def stats(self):
+        with self.__condition:
+            return {"waiting": len(self.__queue), **self.__counts}
+
+    def __count(self, name, result = None):
+        self.__counts[name] += 1
+        metrics.inc("ktamv_cloud_uploads_total", result=result or name)
+
+    def __run(self):
+        session = requests.Session()
+        try:
+            delay = 0
+            while True:
+                with self.__condition:
+                    # Wait for a frame, and after a failure for the backoff, unless closing
+                    deadline = time.time() + delay
+                    while not self.__closed and (not self.__queue or time.time() < deadline):
+                        remaining = deadline - time.time() if self.__queue else None
+                        self.__condition.wait(remaining)
+                    if not self.__queue:
+                        break
+                    upload = self.__queue[0]
+                    upload[3] += 1
+
+                sent = self.__send(session, *upload[:3])
+
+                with self.__condition:
+                    if sent or upload[3] >= self.max_attempts or self.__closed:
+                        if self.__queue and self.__queue[0] is upload:
+                            self.__queue.popleft()
+                        metrics.set("ktamv_cloud_upload_queue", len(self.__queue))
+                        if sent:
+                            self.__count("sent")
+                        else:
+                            self.__count("failed")
+                        delay = 0
+                    else:
+                        delay = min(self.backoff * 2 ** (upload[3] - 1), self.max_backoff)
+                        self.log("Retrying cloud upload in %.0f seconds", delay)
+        finally:
+            session.close()
+
+    def __send(self, session, jpeg, points, algorithm):
+        try:
+            data = {'photo': base64.b64encode(jpeg), 'algorithm': algorithm, 'points': str(points)}
+            with metrics.timer("ktamv_stage_seconds", stage="cloud_upload"):
+                response = session.post(self.cloud_url, data=data, timeout=self.timeout)
+            if response.status_code != 200:
+                self.log("Failed to send frame to cloud, got status code %d", response.status_code, level=logging.WARNING)
+                return False
+            self.log(' *** sent frame to cloud **** ')
+            self.log(' *** response = %s **** :', response.text)
+            return True
+        except Exception as e:
+            self.log("Failed to send frame to cloud %s", e, level=logging.WARNING)
+            return False